@@ -1,8 +1,18 @@
 import pygame as pg
-from random import random
+import numpy as np
+import multiprocessing
+import threading
+import os
+from random import random, Random
+from time import perf_counter
 
 import sprites as spr
 import settings as st
+import tiles as tl
+import world_file as wf
+import streaming
+import sand
+import growth
 
 vec = pg.math.Vector2
 
@@ -12,9 +22,73 @@ def collide(sprite, group, dir_):
     collision function
     https://github.com/kidscancode/pygame_tutorials
     '''
+    return resolve(sprite, pg.sprite.spritecollide(sprite, group, False), 
+                   dir_)
+
+
+def collide_grid(sprite, grid, dir_):
+    '''
+    like collide, but only checks the blocks of the grid cells that
+    the sprite overlaps instead of a whole group
+    '''
+    return resolve(sprite, grid.blocks_in_rect(sprite.rect), dir_)
+
+
+def sweep(sprite, grid, axis):
+    '''
+    moves the sprite by its velocity along an axis (0 is x, 1 is y) and 
+    stops it at the first block of the grid on the way, no matter how far
+    it moves in one tick
+    returns the normal along the axis of the side of the block that was
+    hit (-1 or 1), 0 if nothing was hit
+    '''
+    move = sprite.vel[axis]
+    target = sprite.pos[axis] + move
+    start = sprite.rect.topleft[axis]
+    size = sprite.rect.size[axis]
+    # the rows (or columns) that the sprite covers across the motion
+    across = sprite.rect.topleft[1 - axis]
+    first_across = across // st.TILESIZE
+    last_across = (across + sprite.rect.size[1 - axis] - 1) // st.TILESIZE
+    # the rect coordinate at the target (see physics.rect_coordinate)
+    end = int(np.sign(target) * np.floor(abs(target) + 0.5))
+    if move > 0:
+        tiles = range((start + size - 1) // st.TILESIZE + 1,
+                      (end + size - 1) // st.TILESIZE + 1)
+    else:
+        tiles = range(start // st.TILESIZE - 1, end // st.TILESIZE - 1, -1)
+
+    normal = 0
+    for tile in tiles:
+        for other in range(first_across, last_across + 1):
+            key = (tile, other) if axis == 0 else (other, tile)
+            if key in grid.map:
+                break
+        else:
+            continue
+        if move > 0:
+            target = tile * st.TILESIZE - size
+            normal = -1
+        else:
+            target = (tile + 1) * st.TILESIZE
+            normal = 1
+        sprite.vel[axis] = 0
+        break
+
+    sprite.pos[axis] = target
+    if axis == 0:
+        sprite.rect.left = sprite.pos.x
+    else:
+        sprite.rect.top = sprite.pos.y
+    return normal
+
+
+def resolve(sprite, hits, dir_):
+    '''
+    moves the sprite out of the first of the hits along dir_
+    '''
     if dir_ == 'x':
         # horizontal collision
-        hits = pg.sprite.spritecollide(sprite, group, False)
         if hits:
             for hit in hits:
                 if hit == sprite:
@@ -32,7 +106,6 @@ def collide(sprite, group, dir_):
             
     elif dir_ == 'y':
         # vertical collision
-        hits = pg.sprite.spritecollide(sprite, group, False)
         if hits:
             for hit in hits:
                 if hit == sprite:
@@ -50,26 +123,209 @@ def collide(sprite, group, dir_):
     return False
 
 
+def count_neighbors(alive):
+    '''
+    counts the alive neighbors of every cell of a 2D bool array in one pass,
+    cells outside of the array count as alive
+    '''
+    height, width = alive.shape
+    padded = np.pad(alive, 1, constant_values=True).view(np.uint8)
+    count = np.zeros((height, width), dtype=np.uint8)
+    for dy in range(3):
+        for dx in range(3):
+            if dx == 1 and dy == 1:
+                # middle point
+                continue
+            count += padded[dy:dy + height, dx:dx + width]
+    return count
+
+
+def cellular_step(alive, death_limit, birth_limit):
+    '''
+    one step of the cave cellular automaton on a 2D bool array:
+    alive cells die with less than death_limit neighbors,
+    dead cells come alive with at least birth_limit neighbors
+    '''
+    nbs = count_neighbors(alive)
+    return np.where(alive, nbs >= death_limit, nbs >= birth_limit)
+
+
+def split_bands(height, count):
+    '''
+    returns (start, stop) rows of up to count horizontal bands 
+    that cover the whole height
+    '''
+    bounds = np.linspace(0, height, count + 1).astype(int).tolist()
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) 
+            if stop > start]
+
+
+def cellular_band(job):
+    '''
+    runs cellular_step on one horizontal band of the map (in a worker process)
+    the band comes with a halo row above and below, except at the map border
+    where the missing rows count as alive anyway
+    '''
+    band, top, bottom, death_limit, birth_limit = job
+    new_band = cellular_step(band, death_limit, birth_limit)
+    return new_band[top:len(new_band) - bottom]
+
+
+def band_jobs(alive, death_limit, birth_limit, bands):
+    '''
+    returns the jobs for cellular_band, the halo rows are taken from 
+    the previous generation of the whole map
+    '''
+    height = len(alive)
+    jobs = []
+    for start, stop in bands:
+        top = 1 if start > 0 else 0
+        bottom = 1 if stop < height else 0
+        jobs.append((alive[start - top:stop + bottom], top, bottom, 
+                     death_limit, birth_limit))
+    return jobs
+
+
+
+class Chunk_generator:
+    '''
+    generates single sectors of a world on demand (see tl.Tile_map)
+    
+    the noise of every sector only depends on the seed and the sector
+    position, and every sector runs the cellular automaton on itself plus
+    a halo of neighboring tiles, so that the tiles at the sector borders
+    are the same no matter in which order the sectors are generated
+    '''
+    def __init__(self, grid):
+        self.width = grid.width
+        self.height = grid.height
+        self.horizon = grid.horizon
+        self.placement_chance = grid.placement_chance
+        self.death_limit = grid.death_limit
+        self.birth_limit = grid.birth_limit
+        self.no_of_steps = grid.no_of_steps
+        self.treasure_limit = grid.treasure_limit
+        if grid.seed is None:
+            self.seed = grid.random.randrange(2 ** 32)
+        else:
+            self.seed = grid.seed
+        # every step can spread errors from the fake region border one tile
+        # further in, grass and treasure need one more tile around the sector
+        self.halo = self.no_of_steps + 1
+        
+    
+    def noise(self, sector_x, sector_y):
+        # the same noise for a sector every time
+        rng = np.random.default_rng([self.seed % 2 ** 63, sector_x, sector_y])
+        alive = (rng.random((st.SECTOR_HEIGHT, st.SECTOR_WIDTH)) 
+                 < self.placement_chance)
+        # no noise in the sky and in the bottom row, like Grid.place_noise
+        rows = np.arange(sector_y * st.SECTOR_HEIGHT, 
+                         (sector_y + 1) * st.SECTOR_HEIGHT)
+        alive[(rows < self.horizon) | (rows >= self.height - 1)] = False
+        return alive
+    
+    
+    def region(self, x0, y0, x1, y1):
+        '''
+        returns the block IDs of the tiles x0 <= x < x1, y0 <= y < y1
+        '''
+        # tiles with the halo, clipped to the map because the map border
+        # counts as alive in the cellular automaton anyway
+        hx0 = max(0, x0 - self.halo)
+        hy0 = max(0, y0 - self.halo)
+        hx1 = min(self.width, x1 + self.halo)
+        hy1 = min(self.height, y1 + self.halo)
+        
+        # noise of all the sectors that overlap the region
+        sx0 = hx0 // st.SECTOR_WIDTH
+        sy0 = hy0 // st.SECTOR_HEIGHT
+        sx1 = -(-hx1 // st.SECTOR_WIDTH)
+        sy1 = -(-hy1 // st.SECTOR_HEIGHT)
+        noise = np.block([[self.noise(sx, sy) for sx in range(sx0, sx1)]
+                          for sy in range(sy0, sy1)])
+        ox = hx0 - sx0 * st.SECTOR_WIDTH
+        oy = hy0 - sy0 * st.SECTOR_HEIGHT
+        alive = noise[oy:oy + hy1 - hy0, ox:ox + hx1 - hx0]
+        
+        for i in range(self.no_of_steps):
+            alive = cellular_step(alive, self.death_limit, self.birth_limit)
+            
+        # the same as Grid.place_border, in map coordinates
+        ys = np.arange(hy0, hy1)[:, None]
+        xs = np.arange(hx0, hx1)[None, :]
+        ids = np.where(alive, tl.block_id('dirt'), tl.EMPTY).astype(np.uint8)
+        ids[:max(0, self.horizon - hy0)] = tl.EMPTY
+        border = (xs == 0) | (xs == self.width - 1) | (ys == self.height - 1)
+        ids[border] = tl.block_id('stone')
+        
+        filled = ids != tl.EMPTY
+        inside = ((xs > 0) & (xs < self.width - 1) 
+                  & (ys > 0) & (ys < self.height - 1))
+        # grass on top of blocks, like Grid.place_grass
+        above = np.zeros_like(filled)
+        above[1:] = filled[:-1]
+        below = np.zeros_like(filled)
+        below[:-1] = filled[1:]
+        ids[filled & ~above & below & inside] = tl.block_id('grass')
+        # ore in empty tiles with enough neighbors, all at once instead of 
+        # in map order so that it doesn't depend on the other sectors
+        nbs = count_neighbors(filled)
+        ids[~filled & (nbs >= self.treasure_limit) & inside] = tl.block_id('ore')
+        
+        return ids[y0 - hy0:y1 - hy0, x0 - hx0:x1 - hx0]
+    
+    
+    def sector(self, sector_x, sector_y):
+        x = sector_x * st.SECTOR_WIDTH
+        y = sector_y * st.SECTOR_HEIGHT
+        return self.region(x, y, min(x + st.SECTOR_WIDTH, self.width),
+                           min(y + st.SECTOR_HEIGHT, self.height))
+
+
 
 class Grid:
     '''
-    object that generates and holds a 2D array of Block objects 
+    object that generates and holds the tile map of the world
+    and the Block objects that are currently loaded,
     and also has methods for placing and removing them
     '''
-    def __init__(self, game, width, height):
+    def __init__(self, game, width, height, seed=None, chunked=False):
+        # game can be None for generating a world without a window
         self.game = game
         self.width = width
         self.height = height
-        self.map_blueprint = [[None for i in range(width)] for j in range(height)]
-        self.map = [[None for i in range(width)] for j in range(height)]
+        # the same seed always generates the same world
+        self.seed = seed
+        self.random = Random(seed)
+        # generate the sectors when they are loaded instead of all at once
+        self.chunked = chunked
+        # loaded Block objects by (grid_x, grid_y)
+        self.map = {}
         
         self.placement_chance = 0.40
         self.death_limit = 3
         self.birth_limit = 4
         self.no_of_steps = 7
-        self.done = False
-        self.step = 0
-        self.step_small = 0
+        # number of processes for the cellular automaton, None for all cores
+        self.workers = 1
+        self.pool = None
+        # rows that are processed at once, progress is reported after each
+        self.band_height = 32
+        # worker thread for generating in the background
+        self.thread = None
+        self.cancelled = threading.Event()
+        self.reset()
+        
+        # edit journal of the world file (see open_journal())
+        self.world_path = None
+        self.journal = None
+        # worker thread that rewrites the world file
+        self.compaction = None
+        self.compaction_dirty = set()
+        self.compacted = False
+        self.last_flush = 0
+        self.last_compaction = 0
         
         self.treasure_limit = 5
         # height in tiles that are only sky        
@@ -77,129 +333,352 @@ class Grid:
         # the ID of the sector the player is in (see manage_blocks())
         self.sector_w = 0
         self.sector_h = 0
+        self.streamer = None
+        self.sand = None
+        self.random_ticks = None
         
     
     def generate(self):
         '''
-        generates a cave 
+        generates a cave, one step per call
         credits to:
         https://gamedevelopment.tutsplus.com/tutorials/
         generate-random-cave-levels-using-cellular-automata--gamedev-9664
         '''
-        if self.step <= self.no_of_steps:
-            string = ('Loading map: ' + str(self.step) + ' / ' + str(self.no_of_steps))
-            pg.display.set_caption(string)
-        if self.step == 0:
+        if self.chunked:
+            # nothing is generated until a sector is loaded
+            self.map_blueprint = tl.Tile_map(self.width, self.height, 
+                                             Chunk_generator(self))
+            self.step = self.no_of_steps + 1
+            self.done = True
             
-            for y in range(self.horizon, self.height - 1):
-                for x in range(self.width):
-                    if random() < self.placement_chance:
-                        self.map_blueprint[y][x] = 'dirt'
-                    
+        elif self.step == 0:
+            self.timed('noise', self.place_noise)
             self.step += 1
         
         elif 1 <= self.step <= self.no_of_steps:           
-            self.map_blueprint = self.simulation_step(self.map_blueprint)
+            self.cave = self.timed('step ' + str(self.step), 
+                                   self.simulation_step, self.cave)
             self.step += 1
+            if self.step > self.no_of_steps:
+                self.close_pool()
             
         else:
-            # erase sky
-            for y in range(self.horizon):
-                for x in range(self.width):
-                    self.map_blueprint[y][x] = None
-                    
-            # place solid blocks around the map
-            for y in range(self.height):
-                self.map_blueprint[y][0] = 'stone'
-                self.map_blueprint[y][self.width - 1] = 'stone'
-            for x in range(self.width):
-                self.map_blueprint[self.height - 1][x] = 'stone'
-            
-            self.place_grass()
-            self.place_treasure()
+            for name, phase in (('border', self.place_border),
+                                ('place_grass', self.place_grass),
+                                ('place_treasure', self.place_treasure)):
+                self.timed(name, phase)
+                # a cancelled world is not finished
+                if self.cancelled.is_set():
+                    return
             self.done = True
             
-            print(self.step_small)
     
+    def reset(self):
+        '''
+        throws away the generated world so that it can be generated again
+        '''
+        self.random = Random(self.seed)
+        # block IDs of the whole world
+        self.map_blueprint = tl.Tile_map(self.width, self.height)
+        # alive cells of the cellular automaton while generating
+        self.cave = None
+        self.done = False
+        self.step = 0
+        self.step_small = 0
+        # cells that the generation phases have processed so far
+        self.cells_done = 0
+        # (phase name, seconds) for every generation phase that ran
+        self.timings = []
+        
     
-    def simulation_step(self, old_map):
-        new_map = [[None for x in range(self.width)] 
-                      for y in range(self.height)]       
-        for y in range(self.height):
-            for x in range(self.width):
-                self.step_small += 1
-                nbs = self.count_alive_neighbors(old_map, x, y)
+    def load_world(self, path):
+        '''
+        opens a world file instead of generating the world,
+        the sectors are read from the file when they are loaded
+        '''
+        world = wf.World_file(path)
+        if (world.width, world.height) != (self.width, self.height):
+            world.close()
+            raise ValueError('world file has a different map size')
+        self.cancel_generation()
+        self.reset()
+        self.chunked = world.chunked
+        if self.chunked:
+            # sectors that were never generated are generated now
+            self.seed = world.seed
+            world.fallback = Chunk_generator(self)
+        self.map_blueprint = tl.Tile_map(self.width, self.height, world)
+        self.step = self.no_of_steps + 1
+        self.done = True
+        
+        
+    def save_world(self, path):
+        source = self.map_blueprint.source
+        seed = getattr(source, 'seed', self.seed or 0)
+        wf.save_world(path, self.map_blueprint, seed, self.chunked)
+        if isinstance(source, wf.World_file) and source.path == path:
+            # the old file is closed, read the missing sectors from the new one
+            self.map_blueprint.source = wf.World_file(path, source.fallback)
+        
+    
+    def open_journal(self, path):
+        '''
+        from now on every tile edit is recorded in a journal next to the 
+        world file at path, and the world file is rewritten in the 
+        background every st.JOURNAL_COMPACT_INTERVAL seconds
+        a journal that was left behind by a crash is applied first
+        '''
+        journal_path = path + '.journal'
+        source = self.map_blueprint.source
+        loaded_from_path = (isinstance(source, wf.World_file) 
+                            and source.path == path)
+        records = []
+        if loaded_from_path:
+            records = (wf.read_journal(journal_path + '.old') 
+                       + wf.read_journal(journal_path))
+            for x, y, id_ in records:
+                self.map_blueprint.load_region(x, y, x + 1, y + 1)
+                self.map_blueprint.ids[y, x] = id_
+        else:
+            # the journal belongs to a world that is not there anymore
+            for old_path in (journal_path, journal_path + '.old'):
+                if os.path.isfile(old_path):
+                    os.remove(old_path)
+        
+        self.world_path = path
+        self.journal = wf.Edit_journal(journal_path)
+        self.journal.dirty.update((x // st.SECTOR_WIDTH, y // st.SECTOR_HEIGHT)
+                                  for x, y, id_ in records)
+        self.last_flush = self.last_compaction = perf_counter()
+        if not loaded_from_path:
+            # a new world, write it to the file for the first time
+            self.start_compaction()
+            
+    
+    def update_journal(self):
+        '''
+        flushes the journal and starts or finishes rewriting the world file
+        '''
+        if not self.journal:
+            return
+        now = perf_counter()
+        if now - self.last_flush >= st.JOURNAL_FLUSH_INTERVAL:
+            self.journal.flush()
+            self.last_flush = now
+        if self.compaction:
+            if not self.compaction.is_alive():
+                self.finish_compaction()
+        elif (self.journal.dirty and now - self.last_compaction 
+                >= st.JOURNAL_COMPACT_INTERVAL):
+            self.start_compaction()
+            
+            
+    def start_compaction(self):
+        # the edits until now go into the new world file,
+        # the journal starts over
+        self.compaction_dirty = self.journal.rotate()
+        self.compaction = threading.Thread(target=self.compact, daemon=True)
+        self.compaction.start()
+        self.last_compaction = perf_counter()
+        
+    
+    def compact(self):
+        # runs on the compaction thread
+        source = self.map_blueprint.source
+        seed = getattr(source, 'seed', self.seed or 0)
+        try:
+            wf.write_world(self.world_path + '.tmp', self.map_blueprint, seed,
+                           self.chunked, dirty=self.compaction_dirty)
+            self.compacted = True
+        except OSError as error:
+            print('could not save the world: ' + str(error))
+            self.compacted = False
+            
+    
+    def finish_compaction(self):
+        self.compaction.join()
+        self.compaction = None
+        if not self.compacted:
+            # the records are still in the journal, try again later
+            self.journal.dirty |= self.compaction_dirty
+            return
+        source = self.map_blueprint.source
+        wf.replace_world(self.world_path + '.tmp', self.world_path, source)
+        if isinstance(source, wf.World_file):
+            source = source.fallback
+        # unloaded sectors are read from the new file from now on
+        self.map_blueprint.source = wf.World_file(self.world_path, source)
+        self.journal.remove_rotated()
+        
+    
+    def close_journal(self):
+        '''
+        writes all edits to the world file and removes the journal
+        '''
+        if not self.journal:
+            return
+        if self.compaction:
+            self.finish_compaction()
+        self.start_compaction()
+        self.finish_compaction()
+        self.journal.close()
+        if self.compacted:
+            os.remove(self.journal.path)
+        self.journal = None
+        
+    
+    def generate_all(self):
+        while not self.done and not self.cancelled.is_set():
+            self.generate()
+        self.close_pool()
+        
+    
+    def start_generation(self):
+        '''
+        generates the world on a worker thread, the game can check
+        self.done and self.progress() in the meantime
+        '''
+        self.cancel_generation()
+        self.reset()
+        self.thread = threading.Thread(target=self.generate_all, daemon=True)
+        self.thread.start()
+        
+    
+    def cancel_generation(self):
+        if self.thread:
+            self.cancelled.set()
+            self.thread.join()
+            self.thread = None
+        self.cancelled.clear()
+        
+    
+    def generating(self):
+        return self.thread is not None and self.thread.is_alive()
+    
+    
+    def progress(self):
+        '''
+        returns the fraction of the generation work that is done
+        '''
+        if self.done:
+            return 1
+        total = ((self.height - 1 - self.horizon) * self.width 
+                 + (self.no_of_steps + 2) * self.width * self.height)
+        return min(1, self.cells_done / total)
+            
+    
+    def timed(self, name, function, *args):
+        start = perf_counter()
+        result = function(*args)
+        self.timings.append((name, perf_counter() - start))
+        return result
+    
+    
+    def place_noise(self):
+        # random noise, drawn row by row like the map is read
+        self.cave = np.zeros((self.height, self.width), dtype=bool)
+        for start, stop in split_bands(self.height - 1 - self.horizon, 
+                                       -(-self.height // self.band_height)):
+            if self.cancelled.is_set():
+                return
+            noise = [self.random.random() for i in range((stop - start) 
+                                                         * self.width)]
+            noise = np.array(noise).reshape(-1, self.width)
+            self.cave[self.horizon + start:self.horizon + stop] = (
+                    noise < self.placement_chance)
+            self.cells_done += noise.size
+        
+    
+    def place_border(self):
+        self.map_blueprint.ids[self.cave] = tl.block_id('dirt')
+        self.cave = None
+        
+        # erase sky
+        self.map_blueprint[:self.horizon] = None
                 
-                if old_map[y][x] == 'dirt':
-                    if nbs < self.death_limit:
-                        new_map[y][x] = None
-                    else:
-                        new_map[y][x] = 'dirt'
-                else:
-                    if nbs < self.birth_limit:
-                        new_map[y][x] = None
-                    else:
-                        new_map[y][x] = 'dirt'
-        return new_map
-                          
+        # place solid blocks around the map
+        self.map_blueprint[:, 0] = 'stone'
+        self.map_blueprint[:, self.width - 1] = 'stone'
+        self.map_blueprint[self.height - 1] = 'stone'
+    
+    
+    def simulation_step(self, old_map):
+        '''
+        takes a 2D bool array of alive cells and returns the next generation
+        the map is processed in horizontal bands, with more than one
+        worker the bands are split between the processes of a pool
+        '''
+        workers = self.workers or multiprocessing.cpu_count()
+        count = max(workers, -(-self.height // self.band_height))
+        bands = split_bands(self.height, count)
+        jobs = band_jobs(old_map, self.death_limit, self.birth_limit, bands)
+        if workers <= 1:
+            results = map(cellular_band, jobs)
+        else:
+            if not self.pool:
+                self.pool = multiprocessing.Pool(workers)
+            results = self.pool.imap(cellular_band, jobs)
+        
+        new_bands = []
+        for band in results:
+            if self.cancelled.is_set():
+                return old_map
+            new_bands.append(band)
+            self.step_small += band.size
+            self.cells_done += band.size
+        return np.concatenate(new_bands)
     
-    def count_alive_neighbors(self, map_,  x, y):
-        count = 0
-        for i in range(-1, 2):
-            for j in range(-1, 2):
-                neighbor_x = x + i
-                neighbor_y = y + j
-                if i == 0 and j == 0:
-                    # middle point
-                    pass
-                elif (neighbor_x < 0 or neighbor_y < 0 or 
-                      neighbor_x >= self.width or neighbor_y >= self.height):
-                    count += 1
-                elif map_[neighbor_y][neighbor_x]:
-                    count += 1    
-        return count
     
+    def close_pool(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+                          
     
     def place_grass(self):
         # place grass block if there is a block below and 
         # no block above
-        for y in range(1, self.height - 1):
-            for x in range(1, self.width - 1):
-                if (self.map_blueprint[y][x] != None 
-                        and self.map_blueprint[y - 1][x] == None
-                        and self.map_blueprint[y + 1][x] != None):
-                    self.map_blueprint[y][x] = 'grass'
+        filled = self.map_blueprint.filled()
+        grass = filled[1:-1] & ~filled[:-2] & filled[2:]
+        grass[:, 0] = False
+        grass[:, -1] = False
+        self.map_blueprint.ids[1:-1][grass] = tl.block_id('grass')
+        self.cells_done += filled.size
                     
     
     def place_treasure(self):
+        # place ore in empty tiles with at least treasure_limit neighbors,
+        # row by row from top left so that the ore placed before counts 
+        # as a neighbor (the same as checking every tile in order)
+        ids = self.map_blueprint.ids
         for y in range(1, self.height - 1):
-            for x in range(1, self.width - 1):
-                if self.map_blueprint[y][x] == None:
-                    nbs = self.count_alive_neighbors(self.map_blueprint, x, y)
-                    if nbs >= self.treasure_limit:
-                        self.map_blueprint[y][x] = 'ore'
+            if self.cancelled.is_set():
+                return
+            self.cells_done += self.width
+            filled = ids[y - 1:y + 2] != tl.EMPTY
+            nbs = count_neighbors(filled)[1]
+            empty = ~filled[1]
+            empty[0] = False
+            empty[-1] = False
+            ore = empty & (nbs >= self.treasure_limit)
+            # one neighbor short: ore if the tile to the left became ore
+            short = empty & (nbs == self.treasure_limit - 1)
+            while True:
+                chained = ore.copy()
+                chained[1:] |= short[1:] & ore[:-1]
+                if (chained == ore).all():
+                    break
+                ore = chained
+            ids[y][ore] = tl.block_id('ore')
     
     
     def manage_blocks_initial(self):
-        player = self.game.player
-        self.sector_w = int((player.pos.x / st.MAP_WIDTH) * st.NO_SECTORS_W)
-        self.sector_h = int((player.pos.y / st.MAP_HEIGHT) * st.NO_SECTORS_H)
-        for i in range(self.width):
-            # load sector the player is in and the adjacent ones
-            # load horizontal sectors
-            if (i >= (self.sector_w - 1) * st.SECTOR_WIDTH 
-                and i < (self.sector_w + 2) * st.SECTOR_WIDTH):
-                for j in range(self.height):
-                    # load vertical sectors
-                    if (j >= (self.sector_h - 1)  * st.SECTOR_HEIGHT 
-                        and j < (self.sector_h + 2) * st.SECTOR_HEIGHT):
-                    
-                        if self.map_blueprint[j][i]:
-                            b_x = int(i * st.TILESIZE)
-                            b_y = int(j * st.TILESIZE)
-                            # place block sprite
-                            self.map[j][i] = spr.Block(self.game, 
-                                    self.map_blueprint[j][i], b_x, b_y)
+        self.sand = sand.Sand_simulation(self)
+        self.random_ticks = growth.Random_ticks(self)
+        self.streamer = streaming.Sector_streamer(self)
+        self.manage_blocks()
     
     
     def manage_blocks(self):
@@ -207,195 +686,107 @@ class Grid:
         creates and deletes blocks around the players FOV
         '''                    
         player = self.game.player
-        # calculating the sector the player is in
-        change_w = 0
-        change_h = 0
-        sector_w = int((player.pos.x / st.MAP_WIDTH)  * st.NO_SECTORS_W)
-        sector_h = int((player.pos.y / st.MAP_HEIGHT) * st.NO_SECTORS_H)
-        
-        if sector_w != self.sector_w:
-            change_w = sector_w - self.sector_w
-            self.sector_w = sector_w
-            
-        if sector_h != self.sector_h:
-            change_h = sector_h - self.sector_h
-            self.sector_h = sector_h
-        
-        # define boundaries for looping through the grid
-        start_w = max(0, (self.sector_w - 2) * st.SECTOR_WIDTH)
-        stop_w = min((self.sector_w + 3) * st.SECTOR_WIDTH, self.width)
-        start_h = max(0, (self.sector_h - 2) * st.SECTOR_HEIGHT)
-        stop_h = min((self.sector_h + 3) * st.SECTOR_HEIGHT, self.height)
-
-        if change_w != 0:
-            # if the player went to a different sector horizontally
-            # load blocks in sector based on direction
-            # MEMO: THIS IS TOO MUCH CODE!?!?   
-            for i in range(start_w, stop_w):
-                if change_w == 1:
-                    # player went right
-                    # load sector the player is going to
-                    if (i >= (self.sector_w + 1) * st.SECTOR_WIDTH and 
-                        i < (self.sector_w + 2) * st.SECTOR_WIDTH):
-                        
-                        for j in range(start_h, stop_h): 
-                            if (j >= (self.sector_h - 1) * st.SECTOR_HEIGHT 
-                                and j < (self.sector_h + 2) * st.SECTOR_HEIGHT):
-                                if self.map_blueprint[j][i]:
-                                    b_x = int(i * st.TILESIZE)
-                                    b_y = int(j * st.TILESIZE)
-                                    # place block sprite
-                                    self.map[j][i] = spr.Block(self.game, 
-                                            self.map_blueprint[j][i], b_x, b_y)
-
-                    # unload the sector the player is leaving
-                    if (i < (self.sector_w - 1) * st.SECTOR_WIDTH):
-                        for j in range(start_h, stop_h):
-                            if (j >= (self.sector_h - 1) * st.SECTOR_HEIGHT 
-                                and j < (self.sector_h + 2) * st.SECTOR_HEIGHT):
-                                if self.map[j][i]:
-                                    # remove block sprite
-                                    self.map[j][i].kill()
-                                    self.map[j][i] = None
-                                
-                elif change_w == -1:  
-                    # player went left
-                    # load sector the player is going to
-                    if (i < self.sector_w * st.SECTOR_WIDTH and 
-                        i >= (self.sector_w - 1) * st.SECTOR_WIDTH):
-                        
-                        for j in range(start_h, stop_h):
-                            if (j >= (self.sector_h - 1) * st.SECTOR_HEIGHT 
-                                and j < (self.sector_h + 2) * st.SECTOR_HEIGHT):
-                                if self.map_blueprint[j][i]:
-                                    b_x = int(i * st.TILESIZE)
-                                    b_y = int(j * st.TILESIZE)
-                                    # place block sprite
-                                    self.map[j][i] = spr.Block(self.game, 
-                                            self.map_blueprint[j][i], b_x, b_y)
-                                
-                    # unload the sector the player is leaving
-                    if (i >= (self.sector_w + 2) * st.SECTOR_WIDTH):
-                        for j in range(start_h, stop_h):
-                            if (j >= (self.sector_h - 1) * st.SECTOR_HEIGHT 
-                                and j < (self.sector_h + 2) * st.SECTOR_HEIGHT):
-                                if self.map[j][i]:
-                                    # remove block sprite
-                                    self.map[j][i].kill()
-                                    self.map[j][i] = None
-    
-        if change_h != 0:
-            for i in range(start_w, stop_w):
-                if change_h == 1:
-                    # player went down
-                    # load sector the player is going to
-                    if (i >= (self.sector_w - 1) * st.SECTOR_WIDTH and 
-                        i < (self.sector_w + 2) * st.SECTOR_WIDTH):
-                        for j in range(start_h, stop_h): 
-                            if (j >= (self.sector_h + 1) * st.SECTOR_HEIGHT 
-                                and j < (self.sector_h + 2) * st.SECTOR_HEIGHT):
-                                if self.map_blueprint[j][i]:
-                                    b_x = int(i * st.TILESIZE)
-                                    b_y = int(j * st.TILESIZE)
-                                    # place block sprite
-                                    self.map[j][i] = spr.Block(self.game, 
-                                            self.map_blueprint[j][i], b_x, b_y)
-
-                            # unload the sector the player is leaving
-                            if (j < (self.sector_h - 1) * st.SECTOR_HEIGHT):
-                                for k in range(start_w, stop_w):
-                                    if (k >= (self.sector_w - 1) * st.SECTOR_WIDTH and 
-                                        k < (self.sector_w + 2) * st.SECTOR_WIDTH):
-                                        if self.map[j][k]:
-                                            # remove block sprite
-                                            self.map[j][k].kill()
-                                            self.map[j][k] = None
-                
-                elif change_h == -1:
-                    # player went up
-                    # load sector the player is going to
-                    if (i >= (self.sector_w - 1) * st.SECTOR_WIDTH and 
-                        i < (self.sector_w + 2) * st.SECTOR_WIDTH):
-                        for j in range(start_h, stop_h):  
-                            if (j >= (self.sector_h - 1) * st.SECTOR_HEIGHT 
-                                and j < self.sector_h * st.SECTOR_HEIGHT):
-                                if self.map_blueprint[j][i]:
-                                    b_x = int(i * st.TILESIZE)
-                                    b_y = int(j * st.TILESIZE)
-                                    # place block sprite
-                                    self.map[j][i] = spr.Block(self.game, 
-                                            self.map_blueprint[j][i], b_x, b_y)
-
-                            # unload the sector the player is leaving
-                            if (j >= (self.sector_h + 2) * st.SECTOR_HEIGHT):
-                                for k in range(start_w, stop_w):
-                                    if (k >= (self.sector_w - 1) * st.SECTOR_WIDTH and 
-                                        k < (self.sector_w + 2) * st.SECTOR_WIDTH):
-                                        if self.map[j][k]:
-                                            # remove block sprite
-                                            self.map[j][k].kill()
-                                            self.map[j][k] = None
+        self.streamer.update(player.pos, player.vel)
+        # the ID of the sector the player is in
+        self.sector_w, self.sector_h = self.streamer.sector
 
     
     def add(self, pos, type_):
         grid_x = int(pos.x // st.TILESIZE)
         grid_y = int(pos.y // st.TILESIZE)
-        if not self.map[grid_y][grid_x]:
+        if (grid_x, grid_y) not in self.map:
             b = spr.Block(self.game, type_, pos.x, pos.y)
-            self.map[grid_y][grid_x] = b
+            self.map[(grid_x, grid_y)] = b
             
             
     def set_at(self, pos, type_):
         grid_x = int(pos.x // st.TILESIZE)
         grid_y = int(pos.y // st.TILESIZE)
         b = spr.Block(self.game, type_, pos.x, pos.y)
-        self.map[grid_y][grid_x] = b
+        self.map[(grid_x, grid_y)] = b
             
     
     def block_add(self, pos, block):
         grid_x = int(pos.x // st.TILESIZE)
         grid_y = int(pos.y // st.TILESIZE)
-        if self.map[grid_y][grid_x] == None:
-            self.map[grid_y][grid_x] = block
+        if (grid_x, grid_y) not in self.map:
+            self.map[(grid_x, grid_y)] = block
             
     
     def player_add(self, pos, type_):
         grid_x = int(pos.x // st.TILESIZE)
         grid_y = int(pos.y // st.TILESIZE)
-        if self.map[grid_y][grid_x] == None:
+        if (grid_x, grid_y) not in self.map:
             inv = self.game.player.inventory
             if type_ in inv:
                 if inv[type_] > 0:
                     inv[type_] -= 1
                     b = spr.Block(self.game, type_, pos.x, pos.y)
-                    self.map[grid_y][grid_x] = b
-                    self.map_blueprint[grid_y][grid_x] = type_
+                    self.map[(grid_x, grid_y)] = b
+                    self.set_tile(pos, type_)
             
     
     def remove_at(self, pos):
         grid_x = int(pos.x // st.TILESIZE)
         grid_y = int(pos.y // st.TILESIZE)
-        block = self.map[grid_y][grid_x]
-        if block:
-            self.map[grid_y][grid_x] = None
+        self.map.pop((grid_x, grid_y), None)
             
     
     def player_remove_at(self, pos):
         grid_x = int(pos.x // st.TILESIZE)
         grid_y = int(pos.y // st.TILESIZE)
-        block = self.map[grid_y][grid_x]
+        block = self.map.pop((grid_x, grid_y), None)
         if block:
             spr.Block_drop(block.game, block.type, (block.rect.centerx - 5
                                                 + random() - 0.5,
                                                 block.rect.centery))
-            self.map[grid_y][grid_x] = None
-            self.map_blueprint[grid_y][grid_x] = None
+            self.set_tile(pos, None)
+            
+    
+    def set_tile(self, pos, type_):
+        '''
+        changes a tile of the world map and records it in the edit journal
+        '''
+        grid_x = int(pos[0] // st.TILESIZE)
+        grid_y = int(pos[1] // st.TILESIZE)
+        self.map_blueprint[grid_y, grid_x] = type_
+        if self.journal:
+            self.journal.append(grid_x, grid_y, tl.block_id(type_))
+        if self.game:
+            self.game.terrain.invalidate(grid_x, grid_y)
+            self.sand.mark(grid_x, grid_y)
+            self.wake(grid_x, grid_y)
+            
+            
+    def wake(self, grid_x, grid_y):
+        '''
+        makes the moving sprites around a tile active again
+        '''
+        rect = pg.Rect((grid_x - 1) * st.TILESIZE, (grid_y - 1) * st.TILESIZE,
+                       3 * st.TILESIZE, 3 * st.TILESIZE)
+        self.game.active.add(*self.game.entities.query(rect))
             
     
     def get_at(self, pos):
         grid_x = int(pos[0] // st.TILESIZE)
         grid_y = int(pos[1] // st.TILESIZE)
-        return self.map[grid_y][grid_x]
+        return self.map.get((grid_x, grid_y))
+    
+    
+    def blocks_in_rect(self, rect):
+        '''
+        returns the loaded blocks that collide with a rect in pixels,
+        row by row from the top left
+        '''
+        hits = []
+        for grid_y in range(rect.top // st.TILESIZE, 
+                            (rect.bottom - 1) // st.TILESIZE + 1):
+            for grid_x in range(rect.left // st.TILESIZE, 
+                                (rect.right - 1) // st.TILESIZE + 1):
+                block = self.map.get((grid_x, grid_y))
+                if block and block.rect.colliderect(rect):
+                    hits.append(block)
+        return hits
         
 
 
@@ -419,10 +810,17 @@ class Camera:
     
     def apply_point_reverse(self, point):
         return point + vec(self.camera.x, self.camera.y)
+    
+    def view_rect(self):
+        # the part of the map that is on the screen
+        return pg.Rect(-self.camera.x, -self.camera.y, 
+                       st.SCREEN_WIDTH, st.SCREEN_HEIGHT)
 
-    def update(self, target):
-        x = -target.rect.x + st.SCREEN_WIDTH // 2
-        y = -target.rect.y + st.SCREEN_HEIGHT // 2
+    def update(self, target, rect=None):
+        # rect replaces the rect of the target
+        rect = rect or target.rect
+        x = -rect.x + st.SCREEN_WIDTH // 2
+        y = -rect.y + st.SCREEN_HEIGHT // 2
 
         # limit scrolling to map size
         x = min(0, x) # left
@@ -435,76 +833,92 @@ class Camera:
        
 
 
-class Quadtree:
-    def __init__(self, boundary, capacity):
-        # boundary has to be a pg.Rect object
-        if not isinstance(boundary, pg.Rect):
-            print('boundary has to be a Rect object')
-        self.boundary = boundary
-        self.capacity = capacity
-        self.sprites = []
-        self.divided = False
+class Spatial_hash(pg.sprite.AbstractGroup):
+    '''
+    sprite group that also sorts its sprites into square cells of
+    cell_size pixels, so that the sprites in a rect can be found without 
+    checking all of them
+    a sprite is in every cell that its rect overlaps, call move() after
+    a sprite moved
+    '''
+    def __init__(self, cell_size=st.HASH_CELL_SIZE):
+        super().__init__()
+        self.cell_size = cell_size
+        # (cell_x, cell_y) -> set of sprites
+        self.buckets = {}
+        # sprite -> range of cells (x0, y0, x1, y1) it is in
+        self.ranges = {}
     
     
-    def subdivide(self):
-        x = self.boundary.x
-        y = self.boundary.y
-        w = self.boundary.w / 2
-        h = self.boundary.h / 2
-        
-        ne = pg.Rect(x, y, w, h)
-        self.northeast = Quadtree(ne, self.capacity)
-        nw = pg.Rect(x + w, y, w, h)
-        self.northwest = Quadtree(nw, self.capacity)
-        se = pg.Rect(x, y + h, w, h)
-        self.southeast = Quadtree(se, self.capacity)
-        sw = pg.Rect(x + w, y + h, w, h)
-        self.southwest = Quadtree(sw, self.capacity)
-        
-        self.divided = True
-        
+    def cell_range(self, rect):
+        size = self.cell_size
+        return (rect.left // size, rect.top // size,
+                (rect.right - 1) // size, (rect.bottom - 1) // size)
     
-    def insert(self, sprite):
-        if not self.boundary.collidepoint(sprite.pos):
-            return False
+    
+    def cells(self, cell_range):
+        x0, y0, x1, y1 = cell_range
+        return {(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)}
         
-        if len(self.sprites) < self.capacity:
-            self.sprites.append(sprite)
-            return True
         
-        if not self.divided:
-            self.subdivide()
+    def add_internal(self, sprite, layer=None):
+        # called by pygame when a sprite is added to the group
+        super().add_internal(sprite)
+        self.ranges[sprite] = self.cell_range(sprite.rect)
+        for cell in self.cells(self.ranges[sprite]):
+            self.buckets.setdefault(cell, set()).add(sprite)
             
-        return (self.northeast.insert(sprite) or self.northwest.insert(sprite)
-                or self.southeast.insert(sprite) or self.southwest.insert(sprite))
-        
-        
-    def query(self, rect, found=None):
-        if found == None:
-            found = []
             
-        if not rect.colliderect(self.boundary):
-            return found
+    def remove_internal(self, sprite):
+        # called by pygame when a sprite is removed or killed
+        super().remove_internal(sprite)
+        self.remove_from_cells(sprite, self.cells(self.ranges.pop(sprite)))
         
-        for s in self.sprites:
-            if rect.collidepoint(s.pos):
-                found.append(s)
-                
-        if self.divided:
-            self.northwest.query(rect, found)
-            self.northeast.query(rect, found)
-            self.southwest.query(rect, found)
-            self.southeast.query(rect, found)
-
-        return found
+        
+    def remove_from_cells(self, sprite, cells):
+        for cell in cells:
+            bucket = self.buckets[cell]
+            bucket.discard(sprite)
+            if not bucket:
+                del self.buckets[cell]
     
     
-    def draw(self, screen):
-        pg.draw.rect(screen, (100, 100, 100), self.boundary, 1)
-        
-        if self.divided:
-            self.northwest.draw(screen)
-            self.northeast.draw(screen)
-            self.southwest.draw(screen)
-            self.southeast.draw(screen)
-            
\ No newline at end of file
+    def move(self, sprite):
+        '''
+        sorts a sprite into the cells of its current rect
+        returns True if it is in different cells now
+        '''
+        old = self.ranges.get(sprite)
+        new = self.cell_range(sprite.rect)
+        if old is None or old == new:
+            return False
+        self.ranges[sprite] = new
+        old_cells = self.cells(old)
+        new_cells = self.cells(new)
+        self.remove_from_cells(sprite, old_cells - new_cells)
+        for cell in new_cells - old_cells:
+            self.buckets.setdefault(cell, set()).add(sprite)
+        return True
+    
+    
+    def query(self, rect):
+        '''
+        returns the sprites whose rect collides with rect
+        '''
+        found = set()
+        for cell in self.cells(self.cell_range(rect)):
+            bucket = self.buckets.get(cell)
+            if bucket:
+                found |= bucket
+        return [sprite for sprite in found if sprite.rect.colliderect(rect)]
+    
+    
+    def stats(self):
+        '''
+        returns the number of used cells and the mean and maximum 
+        number of sprites in a used cell
+        '''
+        if not self.buckets:
+            return 0, 0, 0
+        sizes = [len(bucket) for bucket in self.buckets.values()]
+        return len(sizes), sum(sizes) / len(sizes), max(sizes)
@@ -0,0 +1,169 @@
+import os
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import argparse
+import json
+import zlib
+from time import perf_counter
+
+import pygame as pg
+
+import functions as fn
+import settings as st
+import world_file as wf
+
+'''
+Generates a world without opening a window and reports the wall time
+of every generation phase
+
+example:
+    python generate_world.py --seed 42 --width 2800 --height 1000
+    python generate_world.py --load world.dat --image world.png --scale 2
+'''
+
+
+def seed(value):
+    # the world file stores the seed as an unsigned 64 bit number
+    value = int(value)
+    if not 0 <= value < 2 ** 64:
+        raise argparse.ArgumentTypeError('%d is not between 0 and 2**64 - 1'
+                                         % value)
+    return value
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+            description='generate a world without a display')
+    parser.add_argument('--seed', type=seed, default=0)
+    parser.add_argument('--preset', choices=list(st.WORLD_PRESETS),
+                        help='world size and workers from st.WORLD_PRESETS')
+    parser.add_argument('--width', type=int,
+                        help='map width in tiles')
+    parser.add_argument('--height', type=int,
+                        help='map height in tiles')
+    parser.add_argument('--workers', type=int,
+                        help='processes for the cellular automaton, '
+                             '0 uses all cores')
+    parser.add_argument('--placement-chance', type=float, default=0.40)
+    parser.add_argument('--death-limit', type=int, default=3)
+    parser.add_argument('--birth-limit', type=int, default=4)
+    parser.add_argument('--steps', type=int, default=7,
+                        help='number of cellular automaton steps')
+    parser.add_argument('--chunked', action='store_true',
+                        help='generate the world sector by sector '
+                             'like a chunked world in the game')
+    parser.add_argument('--save', metavar='PATH',
+                        help='write the world to a world file')
+    parser.add_argument('--load', metavar='PATH',
+                        help='open a world file instead of generating')
+    parser.add_argument('--image', metavar='PATH',
+                        help='save an image of the world')
+    parser.add_argument('--scale', type=int, default=4,
+                        help='pixels per tile in the image')
+    parser.add_argument('--crop', metavar='X,Y,W,H',
+                        type=lambda text: tuple(map(int, text.split(','))),
+                        help='only put these tiles in the image')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as json')
+    args = parser.parse_args(args)
+    
+    # explicit values override the preset
+    preset = st.WORLD_PRESETS.get(args.preset, {})
+    if args.width is None:
+        args.width = preset.get('width', st.MAP_WIDTH // st.TILESIZE)
+    if args.height is None:
+        args.height = preset.get('height', st.MAP_HEIGHT // st.TILESIZE)
+    if args.workers is None:
+        args.workers = preset.get('workers', 1)
+    return args
+
+
+def generate_world(seed, width, height, placement_chance=0.40,
+                   death_limit=3, birth_limit=4, steps=7, workers=1,
+                   chunked=False):
+    '''
+    returns a fully generated Grid that is not attached to a game
+    workers > 1 (or None for all cores) runs the cellular automaton
+    in a process pool, the world is the same as with one worker
+    chunked generates every sector on its own (a different world)
+    '''
+    grid = fn.Grid(None, width, height, seed, chunked)
+    grid.placement_chance = placement_chance
+    grid.death_limit = death_limit
+    grid.birth_limit = birth_limit
+    grid.no_of_steps = steps
+    grid.workers = workers
+    grid.generate_all()
+    if chunked:
+        grid.timed('chunks', grid.map_blueprint.load_region, 0, 0, 
+                   width, height)
+    return grid
+
+
+def load_world(path):
+    '''
+    returns a Grid with the world of a world file
+    '''
+    world = wf.World_file(path)
+    grid = fn.Grid(None, world.width, world.height, world.seed)
+    world.close()
+    grid.load_world(path)
+    return grid
+
+
+def save_image(grid, path, scale=4, region=None):
+    surf = grid.map_blueprint.image(scale, region)
+    if surf is None:
+        print('no tiles in the image region, ' + path + ' is not written')
+        return
+    pg.image.save(surf, path)
+
+
+def report(grid, total):
+    return {
+            'seed': grid.seed,
+            'width': grid.width,
+            'height': grid.height,
+            'workers': grid.workers,
+            'chunked': grid.chunked,
+            'checksum': zlib.crc32(grid.map_blueprint.ids.tobytes()),
+            'phases': [{'phase': name, 'seconds': seconds}
+                       for name, seconds in grid.timings],
+            'total_seconds': total
+            }
+
+
+def print_report(result):
+    print('world %dx%d  seed %d  checksum %08x' % (result['width'],
+          result['height'], result['seed'], result['checksum']))
+    for phase in result['phases']:
+        print('%-16s %10.2f ms' % (phase['phase'], phase['seconds'] * 1000))
+    print('%-16s %10.2f ms' % ('total', result['total_seconds'] * 1000))
+
+
+def main(args=None):
+    args = parse_args(args)
+    start = perf_counter()
+    if args.load:
+        grid = load_world(args.load)
+        grid.timed('load', grid.map_blueprint.load_region, 0, 0, 
+                   grid.width, grid.height)
+    else:
+        grid = generate_world(args.seed, args.width, args.height,
+                              args.placement_chance, args.death_limit,
+                              args.birth_limit, args.steps, 
+                              args.workers or None, args.chunked)
+    if args.image:
+        grid.timed('image', save_image, grid, args.image, args.scale, 
+                   args.crop)
+    if args.save:
+        grid.timed('save', grid.save_world, args.save)
+    result = report(grid, perf_counter() - start)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import numpy as np
+
+import settings as st
+import tiles as tl
+import streaming
+
+'''
+Slow changes of the world map, like dirt that turns into grass
+
+instead of a counter in every block, every tick picks a few random tiles
+of every loaded sector and lets them grow with a small chance. sectors
+that are not loaded don't get ticks, the growth they missed is done at
+once when they are loaded again (sectors that were never loaded before
+start growing when they are first loaded)
+'''
+
+DIRT = tl.block_id('dirt')
+
+
+
+class Random_ticks:
+    def __init__(self, grid, per_sector=st.RANDOM_TICKS_PER_SECTOR,
+                 growth_ticks=st.GRASS_GROWTH_TICKS):
+        self.grid = grid
+        self.per_sector = per_sector
+        self.tick = 0
+        # sector -> tick up to which its growth is done, for the sectors
+        # that were loaded before
+        self.updated = {}
+        # chance that a tile that can grow does so in one tick, and the
+        # chance that it grows when it is picked by a random tick
+        self.chance = 1 / growth_ticks
+        self.pick_chance = min(1, self.chance * st.SECTOR_WIDTH
+                                  * st.SECTOR_HEIGHT / per_sector)
+        self.random = np.random.default_rng()
+        self.grown = 0
+
+
+    def can_grow(self, x, y):
+        '''
+        returns which of the tiles at the arrays x, y are dirt with
+        nothing above and a block below
+        '''
+        ids = self.grid.map_blueprint.ids
+        height = ids.shape[0]
+        above = np.where(y > 0, ids[np.maximum(y - 1, 0), x], tl.EMPTY)
+        below = np.where(y < height - 1, ids[np.minimum(y + 1, height - 1), x],
+                         tl.EMPTY)
+        return (ids[y, x] == DIRT) & (above == tl.EMPTY) & (below != tl.EMPTY)
+
+
+    def update(self):
+        self.tick += 1
+        loaded = self.grid.streamer.loaded
+        if not loaded:
+            return
+        sectors = np.array(list(loaded)).repeat(self.per_sector, axis=0)
+        x = (sectors[:, 0] * st.SECTOR_WIDTH
+             + self.random.integers(0, st.SECTOR_WIDTH, len(sectors)))
+        y = (sectors[:, 1] * st.SECTOR_HEIGHT
+             + self.random.integers(0, st.SECTOR_HEIGHT, len(sectors)))
+        # sectors at the edge of the map can be smaller
+        inside = (x < self.grid.width) & (y < self.grid.height)
+        x, y = x[inside], y[inside]
+        grows = self.can_grow(x, y) & (self.random.random(len(x))
+                                       < self.pick_chance)
+        for i in grows.nonzero()[0]:
+            self.grow(int(x[i]), int(y[i]))
+
+
+    def unloaded(self, sector):
+        self.updated[sector] = self.tick
+
+
+    def catch_up(self, sector):
+        '''
+        does the growth of a sector since it was unloaded
+        '''
+        elapsed = self.tick - self.updated.get(sector, self.tick)
+        self.updated[sector] = self.tick
+        if elapsed <= 0:
+            return
+        grid = self.grid
+        x0, y0, x1, y1 = streaming.sector_tiles(sector, grid.width,
+                                                grid.height)
+        # (with the rows above and below, that update() reads as well)
+        grid.map_blueprint.load_region(x0, y0 - 1, x1, y1 + 1)
+        y, x = np.mgrid[y0:y1, x0:x1]
+        # chance to grow in at least one of the ticks
+        chance = 1 - (1 - self.chance) ** elapsed
+        grows = self.can_grow(x, y) & (self.random.random(x.shape) < chance)
+        for j, i in zip(*grows.nonzero()):
+            self.grow(int(x[j, i]), int(y[j, i]))
+
+
+    def grow(self, grid_x, grid_y):
+        grid = self.grid
+        grid.set_tile((grid_x * st.TILESIZE, grid_y * st.TILESIZE), 'grass')
+        block = grid.map.get((grid_x, grid_y))
+        if block:
+            block.reset('grass', block.pos.x, block.pos.y)
+        self.grown += 1
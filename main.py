@@ -1,26 +1,33 @@
 import pygame as pg
 from random import choice
+from os import path, environ
+from time import perf_counter
+import argparse
 import traceback
 
 import sprites as spr
 import functions as fn
 import settings as st
+import tiles as tl
+import rendering
+import physics
 
 '''
 Simple engine for a Terraria-style game
 
 To Do list:
     - add trees and bushes
-    - quad trees for collision
     - mini map
-    - collide function with only 1 spritecollide call
 '''
 
 vec = pg.math.Vector2
 
 
 class Game:
-    def __init__(self):
+    def __init__(self, world_file=st.WORLD_FILE):
+        # the world is loaded from and saved to world_file,
+        # with None it is neither loaded nor saved
+        self.world_file = world_file
         # initialize pygame
         pg.init()
         self.screen = pg.Surface((st.SCREEN_WIDTH,st. SCREEN_HEIGHT + st.GUI_HEIGHT))
@@ -28,6 +35,10 @@ class Game:
                                                    st.SCREEN_SCALE, 
                                     self.screen.get_height() * st.SCREEN_SCALE))
         self.clock = pg.time.Clock()
+        # surfaces of all block types, shared by the sprites
+        self.atlas = tl.Tile_atlas()
+        # draws the blocks sector by sector
+        self.terrain = rendering.Terrain_renderer(self)
         #pg.mouse.set_visible(False)
         
         self.mouseclickedleft = False
@@ -38,10 +49,22 @@ class Game:
         self.all_sprites = pg.sprite.Group()
         self.blocks = pg.sprite.Group()            
         self.drops = pg.sprite.Group()
+        # drops, sorted by position
+        self.entities = fn.Spatial_hash()
+        # sprites that are updated every frame, the others sleep
+        self.active = pg.sprite.Group()
         
         self.tiles_w = st.MAP_WIDTH // st.TILESIZE
         self.tiles_h =st.MAP_HEIGHT // st.TILESIZE
-        self.grid = fn.Grid(self, self.tiles_w, self.tiles_h)
+        self.grid = fn.Grid(self, self.tiles_w, self.tiles_h, st.WORLD_SEED,
+                            st.CHUNKED_WORLD)
+        # positions and velocities of the drops
+        self.bodies = physics.Body_store(self.grid)
+        if world_file and path.isfile(world_file):
+            try:
+                self.grid.load_world(world_file)
+            except (OSError, ValueError) as error:
+                print('could not load ' + world_file + ': ' + str(error))
 
         self.background = pg.Surface((st.SECTOR_WIDTH * st.TILESIZE * 10 , 
                                       st.SECTOR_HEIGHT * st.TILESIZE * 10))
@@ -49,11 +72,28 @@ class Game:
         self.background.fill(st.SKYBLUE)
         
         self.gui = spr.GUI(self)
+        # only sends the parts of the screen that changed to the display
+        self.display = rendering.Dirty_screen(self)
+        # block cursor for mining and placing blocks
+        self.block_surf = pg.Surface((st.TILESIZE, st.TILESIZE)).convert_alpha()
+        pg.draw.rect(self.block_surf, st.LIGHTGREEN, 
+                     ((0, 0), (st.TILESIZE, st.TILESIZE)))
         
         self.started = False
+        # world generation was cancelled on the loading screen
+        self.generation_cancelled = False
+        # simulation ticks since the start of the game
+        self.ticks = 0
+        # how far the drawn frame is between the last tick and the next
+        self.alpha = 1
         
     
     def start_game(self):
+        # record the edits to the world from now on, the edits that a 
+        # crash left in the journal are applied before anything reads 
+        # the map
+        if self.world_file:
+            self.grid.open_journal(self.world_file)
         spawn_pos = self.find_spawn_position()
         
         self.player = spr.Player(self, spawn_pos.x, spawn_pos.y)
@@ -61,9 +101,6 @@ class Game:
         
         self.grid.manage_blocks_initial()
         
-        # quadtree stuff
-        self.qt_rect = pg.Rect(0, 0, 40 * st.TILESIZE, 60 * st.TILESIZE)
-        
         self.started = True
       
         # ------- debugging!
@@ -72,27 +109,37 @@ class Game:
 
     
     def find_spawn_position(self):
-        spawn_positions = []
         # find empty position:
-        for i in range(1, self.grid.horizon):
-            for j in range(1, self.grid.width - 1):
-                if (self.grid.map_blueprint[i][j] == None 
-                        and self.grid.map_blueprint[i - 1][j] == None
-                        and self.grid.map_blueprint[i + 1][j] != None):
-                    spawn_positions.append(vec(j * st.TILESIZE, i * st.TILESIZE))
+        # an empty tile with an empty tile above and a block below
+        h = self.grid.horizon
+        start = 0
+        stop = self.grid.width
+        if self.grid.chunked:
+            # only search the sectors in the middle of the world
+            start = max(0, (self.grid.width // 2 // st.SECTOR_WIDTH - 1) 
+                        * st.SECTOR_WIDTH)
+            stop = min(start + 3 * st.SECTOR_WIDTH, self.grid.width)
+        # sectors of generated or saved worlds can still be unloaded
+        self.grid.map_blueprint.load_region(start, 0, stop, h + 1)
+        filled = self.grid.map_blueprint.filled()[:h + 1, start:stop]
+        spots = ~filled[1:h] & ~filled[:h - 1] & filled[2:h + 1]
+        if start == 0:
+            spots[:, 0] = False
+        if stop == self.grid.width:
+            spots[:, -1] = False
+        spawn_positions = [vec((start + j) * st.TILESIZE, (i + 1) * st.TILESIZE)
+                           for i, j in zip(*spots.nonzero())]
         return choice(spawn_positions)
     
     
     def save_world_image(self):
-        surf = pg.Surface((self.grid.width * 4, self.grid.height * 4))
-        surf.fill(st.LIGHTBLUE)
-        for i in range(self.grid.height):
-            for j in range(self.grid.width):
-                if self.grid.map_blueprint[i][j]:
-                    color = st.BLOCK_TYPES[self.grid.map_blueprint[i][j]]['color']
-                    pg.draw.rect(surf, color, ((j * 4, i * 4), (4, 4)))
-        
-        pg.image.save(surf, 'world.png')
+        region = None
+        if self.grid.chunked:
+            # only the part of the world that was generated
+            region = self.grid.map_blueprint.loaded_region()
+        surf = self.grid.map_blueprint.image(4, region)
+        if surf is not None:
+            pg.image.save(surf, 'world.png')
         
     
     def draw_sectors(self):
@@ -113,36 +160,55 @@ class Game:
 
     
     def update(self):
+        '''
+        one tick of the simulation
+        '''
         self.grid.manage_blocks()
+        self.grid.sand.update()
+        self.grid.random_ticks.update()
+        self.grid.update_journal()
+        
+        # move all drops, the ones that moved are active
+        for sprite in self.bodies.step():
+            self.active.add(sprite)
+            self.entities.move(sprite)
+        # drops close to the player are pulled towards it
+        self.active.add(*self.entities.query(
+                self.player.rect.inflate(4 * st.TILESIZE, 4 * st.TILESIZE)))
+        for sprite in self.active:
+            sprite.begin_tick()
+            sprite.update()
+            # only sprites that changed cells are sorted again
+            self.entities.move(sprite)
+
+        self.mouseclickedleft = False
+        self.mouseclickedright = False
+        self.ticks += 1
+        
         
+    def update_view(self, alpha):
+        '''
+        updates the camera, the block cursor and the caption for the
+        next frame, alpha is how far the frame is between the last tick
+        and the next one (0 to 1)
+        '''
+        self.alpha = alpha
         caption = ('Sector_w: ' + str(self.grid.sector_w)
             + '  Sector_h: ' + str(self.grid.sector_h)
-            + ' | ' + str(len(self.all_sprites)) + ' sprites | FPS: ' 
+            + ' | ' + str(len(self.active)) + '/' 
+            + str(len(self.all_sprites)) + ' sprites active'
+            + ' | pool: ' + str(self.grid.streamer.pool.size()) + ' blocks, '
+            + str(int(self.grid.streamer.pool.hit_rate() * 100)) + ' % hits'
+            + ' | ' + str(self.terrain.bakes) + ' sector bakes'
+            + ' | ' + self.terrain.stats()
+            + ' | hash: %d cells, %.1f avg, %d max' % self.entities.stats()
+            + ' | redrawn: %d %%' % (self.display.updated * 100)
+            + ' | FPS: ' 
             + str(round(self.clock.get_fps(), 2)))
         
         pg.display.set_caption(caption)
-        
-        
-        # quadtree stuff             
-        self.qtree_rects = []
-        self.qt_rect.center = self.player.rect.center
-        self.qt = fn.Quadtree(self.qt_rect, 4)
-    
-        for sprite in self.all_sprites:
-            self.qt.insert(sprite)
-            if not isinstance(sprite, spr.Block_drop):
-                if sprite == self.player:
-                     sprite.update(self.blocks)
-                else:
-                    sprite.update(self.all_sprites)
-            else:
-                rect = pg.Rect(sprite.pos, (40, 40))
-                rect.center = sprite.rect.center
-                self.qtree_rects.append(self.camera.apply_rect(rect))
-                neighbors = self.qt.query(rect)
-                sprite.update(neighbors)
             
-        self.camera.update(self.player)
+        self.camera.update(self.player, self.player.draw_rect(alpha))
 
         self.m_pos = vec(pg.mouse.get_pos())
         self.m_pos /= st.SCREEN_SCALE
@@ -159,59 +225,60 @@ class Game:
         self.block_pos.y = (self.player.rect.centery + 
                             self.p_to_mouse.y) // st.TILESIZE * st.TILESIZE
         self.block_pos.y = min(self.block_pos.y, st.MAP_HEIGHT - st.TILESIZE)   
-
-        self.mouseclickedleft = False
-        self.mouseclickedright = False
         
         
         
     def draw(self):
+        display = self.display
+        view = display.view
         self.background_rect.centerx = self.player.rect.centerx
-        self.screen.blit(self.background, self.camera.apply_rect(self.background_rect))
+        # static blocks are part of the terrain, everything that 
+        # moves is drawn on top of it
+        display.draw_world(self.camera, self.background, 
+                           self.camera.apply_rect(self.background_rect),
+                           self.grid.streamer.loaded)
         
         # get the rect position of the player on the screen
-        rect = self.camera.apply(self.player)
+        rect = self.camera.apply_rect(self.player.draw_rect(self.alpha))
         
-        for sprite in self.all_sprites:
-            self.screen.blit(sprite.image, self.camera.apply(sprite))
+        drawn = self.terrain.draw_sprites(view, self.camera, self.entities,
+                                          self.alpha)
+        drawn.append(view.blit(self.player.image, rect))
 
         # draw a line from player to mouse
-        pg.draw.line(self.screen, st.BLACK, rect.center, 
-                     rect.center + self.p_to_mouse, 2)       
+        drawn.append(pg.draw.line(view, st.BLACK, rect.center, 
+                                  rect.center + self.p_to_mouse, 2))
         
-        block_surf = pg.Surface((st.TILESIZE, st.TILESIZE)).convert_alpha()      
-        pg.draw.rect(block_surf, st.LIGHTGREEN, ((0, 0), (st.TILESIZE, st.TILESIZE)))
-        block_rect = block_surf.get_rect()
+        block_rect = self.block_surf.get_rect()
         block_rect.topleft = self.block_pos
-        self.screen.blit(block_surf, self.camera.apply_rect(block_rect))
-        
-        # draw quadtree rects
-        #for rect in self.qtree_rects:
-            #pg.draw.rect(self.screen, (0, 255, 0), rect, 1)
-
-        #pg.draw.rect(self.screen, (0, 255, 0), self.camera.apply_rect(self.qt_rect), 2)
+        drawn.append(view.blit(self.block_surf, 
+                               self.camera.apply_rect(block_rect)))
+        display.add(drawn)
         
         #self.draw_sectors()
         
-        self.gui.draw()
+        gui = self.gui.draw(display.full)
+        if gui:
+            display.add([gui], restore=False)
         
-        transformed_screen = pg.transform.scale(self.screen, 
-                                    (self.monitor_screen.get_width(),
-                                    self.monitor_screen.get_height()))
-        self.monitor_screen.blit(transformed_screen, (0, 0))
-     
-        pg.display.update()
+        display.present()
         
     
     def events(self):
         for event in pg.event.get():
             if event.type == pg.QUIT:
-                self.save_world_image()
-                self.running = False
+                self.quit()
+            if event.type == pg.KEYDOWN and not self.started:
+                # loading screen
+                if event.key == pg.K_ESCAPE:
+                    self.grid.cancel_generation()
+                    self.generation_cancelled = True
+                if event.key == pg.K_RETURN:
+                    self.generation_cancelled = False
             # MEMO: EXPORT THE PRESSED KEYS TO A FUNCTION
-            if event.type == pg.KEYDOWN:
+            elif event.type == pg.KEYDOWN:
                 if event.key == pg.K_SPACE:
-                    self.player.jump(self.blocks)
+                    self.player.jump()
                 if event.key == pg.K_r:
                     if len(self.player.inventory_types) > 0:
                         self.player.inventory_selected = (
@@ -225,31 +292,88 @@ class Game:
                     self.mouseclickedright = True
 
 
+    def quit(self):
+        if self.started and self.world_file:
+            self.save_world_image()
+            self.grid.close_journal()
+        self.grid.cancel_generation()
+        self.running = False
+
+
     def run(self):
         # game loop
+        # the simulation runs in ticks of the same length no matter how
+        # long a frame takes, a frame is drawn between two ticks
+        tick = 1 / st.TICK_RATE
+        lag = 0
         self.running = True 
         while self.running:
-            self.clock.tick(60)
+            self.clock.tick(st.FPS)
     
             self.events()
             
             if not self.grid.done:
-                self.grid.generate()
+                # the world is generated on a worker thread
+                if (not self.grid.generating() 
+                        and not self.generation_cancelled):
+                    self.grid.start_generation()
                 self.gui.draw_loading_screen()
             else:
                 if not self.started:
                     self.start_game()
-                self.update()
+                    last_time = perf_counter()
+                now = perf_counter()
+                lag += now - last_time
+                last_time = now
+                
+                ticks = 0
+                while lag >= tick and ticks < st.MAX_CATCH_UP_TICKS:
+                    self.update()
+                    lag -= tick
+                    ticks += 1
+                # the time that can't be caught up is lost
+                lag = min(lag, tick)
+                self.update_view(lag / tick)
                 self.draw()
 
         pg.quit()
+        
+        
+    def run_headless(self, ticks):
+        '''
+        runs the simulation for a number of ticks as fast as possible 
+        without drawing anything, returns the ticks per second
+        '''
+        self.running = True
+        self.grid.generate_all()
+        self.start_game()
+        start = perf_counter()
+        while self.running and self.ticks < ticks:
+            self.events()
+            self.update()
+        seconds = perf_counter() - start
+        self.quit()
+        pg.quit()
+        return self.ticks / seconds
    
     
     
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Terraria-like game')
+    parser.add_argument('--headless', type=int, metavar='TICKS',
+                        help='run this many ticks of the simulation '
+                             'without a window and print the tick rate')
+    args = parser.parse_args()
+    if args.headless:
+        environ['SDL_VIDEODRIVER'] = 'dummy'
     try:       
-        game = Game()
-        game.run()
+        # a benchmark doesn't touch the saved world
+        game = Game(None if args.headless else st.WORLD_FILE)
+        if args.headless:
+            rate = game.run_headless(args.headless)
+            print('%d ticks, %.1f ticks per second' % (game.ticks, rate))
+        else:
+            game.run()
     
     except Exception:
         traceback.print_exc()
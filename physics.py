@@ -0,0 +1,238 @@
+import numpy as np
+
+import settings as st
+
+'''
+Physics of many small bodies at once
+
+the positions, velocities and accelerations of the bodies are kept in
+numpy arrays and every tick moves all of them in one step, with the same
+rules as spr.Physics_object.update: gravity, the falling speed cap and
+swept collisions with the tiles of the world map, first along x, then
+along y
+'''
+
+# the arrays with one row per body
+ARRAYS = ('pos', 'last', 'vel', 'acc', 'gravity', 'normal', 'size')
+
+
+
+def rect_coordinate(values):
+    '''
+    returns the int a pg.Rect stores for float coordinates
+    (rounded half away from zero)
+    '''
+    return (np.sign(values) * np.floor(np.abs(values) + 0.5)).astype(int)
+
+
+
+class Body_store:
+    '''
+    the sprites in the store read and write their pos, vel, acc and
+    gravity through it (see spr.Block_drop), add() returns the index
+    of a sprite in the arrays
+    normal is the normal of the sides of the tiles that a body hit in
+    the last step, like Physics_object.normal
+    '''
+    def __init__(self, grid, capacity=256):
+        self.grid = grid
+        self.count = 0
+        self.sprites = []
+        self.pos = np.zeros((capacity, 2))
+        # positions before the last step, for drawing
+        self.last = np.zeros((capacity, 2))
+        self.vel = np.zeros((capacity, 2))
+        self.acc = np.zeros((capacity, 2))
+        self.gravity = np.zeros((capacity, 2))
+        self.normal = np.zeros((capacity, 2))
+        self.size = np.zeros((capacity, 2), dtype=int)
+
+
+    def add(self, sprite, size):
+        if self.count == len(self.pos):
+            self.grow()
+        index = self.count
+        self.count += 1
+        self.sprites.append(sprite)
+        for name in ARRAYS:
+            getattr(self, name)[index] = 0
+        self.size[index] = size
+        return index
+
+
+    def grow(self):
+        for name in ARRAYS:
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate((array, np.zeros_like(array))))
+
+
+    def remove(self, index):
+        # the last body takes the place of the removed one
+        last = self.count - 1
+        moved = self.sprites.pop()
+        if index != last:
+            for name in ARRAYS:
+                array = getattr(self, name)
+                array[index] = array[last]
+            self.sprites[index] = moved
+            moved.index = index
+        self.count = last
+
+
+    def step(self):
+        '''
+        moves all bodies by one tick
+        returns the sprites whose rects moved
+        '''
+        n = self.count
+        if n == 0:
+            return []
+        pos = self.pos[:n]
+        vel = self.vel[:n]
+        acc = self.acc[:n]
+        self.last[:n] = pos
+        # the rect of the last tick
+        top = rect_coordinate(pos[:, 1])
+
+        acc += self.gravity[:n]
+        vel += 0.5 * acc
+        # cap falling speed
+        vel[vel[:, 1] >= st.MAX_FALL_SPEED + 1, 1] = st.MAX_FALL_SPEED
+        acc[:] = 0
+        self.normal[:n] = 0
+
+        # (collide pushes the bodies out of blocks that were placed
+        # where they are)
+        left = rect_coordinate(pos[:, 0])
+        self.sweep(0, left, top)
+        left = rect_coordinate(pos[:, 0])
+        self.collide(0, left, top)
+        left = rect_coordinate(pos[:, 0])
+        self.sweep(1, left, top)
+        top = rect_coordinate(pos[:, 1])
+        self.collide(1, left, top)
+        top = rect_coordinate(pos[:, 1])
+
+        # compared to the rects and not to the last positions, the sprites
+        # also move between the steps (see spr.Block_drop.update)
+        rects = np.array([sprite.rect.topleft for sprite in self.sprites])
+        moved = ((left != rects[:, 0]) | (top != rects[:, 1])).nonzero()[0]
+        sprites = [self.sprites[i] for i in moved]
+        for i in moved:
+            self.sprites[i].rect.topleft = (left[i], top[i])
+
+        # kill if not in bounds
+        outside = ((pos[:, 0] <= -st.TILESIZE)
+                   | (pos[:, 0] >= st.MAP_WIDTH + st.TILESIZE)
+                   | (pos[:, 1] >= st.MAP_HEIGHT + st.TILESIZE))
+        for sprite in [self.sprites[i] for i in outside.nonzero()[0]]:
+            sprite.kill()
+        return [sprite for sprite in sprites if sprite.alive()]
+
+
+    def solid(self, tile_x, tile_y):
+        '''
+        returns which of the tiles are not empty
+        '''
+        ids = self.grid.map_blueprint.ids
+        height, width = ids.shape
+        inside = ((tile_x >= 0) & (tile_x < width) 
+                  & (tile_y >= 0) & (tile_y < height))
+        return inside & (ids[tile_y.clip(0, height - 1),
+                             tile_x.clip(0, width - 1)] != 0)
+
+
+    def sweep(self, axis, left, top):
+        '''
+        moves the bodies by their velocity along an axis and stops them
+        at the first tile on the way, like fn.sweep
+        '''
+        n = self.count
+        start, across = (left, top) if axis == 0 else (top, left)
+        size = self.size[:n, axis]
+        pos = self.pos[:n, axis]
+        move = self.vel[:n, axis]
+        target = pos + move
+        end = rect_coordinate(target)
+
+        # the tiles along the axis that the bodies move into
+        forward = move > 0
+        first = np.where(forward, (start + size - 1) // st.TILESIZE + 1,
+                         start // st.TILESIZE - 1)
+        last = np.where(forward, (end + size - 1) // st.TILESIZE,
+                        end // st.TILESIZE)
+        step = np.where(forward, 1, -1)
+        count = np.maximum((last - first) * step + 1, 0)
+        # and the tiles they cover across it
+        first_across = across // st.TILESIZE
+        span = ((across + self.size[:n, 1 - axis] - 1) // st.TILESIZE 
+                - first_across + 1)
+
+        hit = np.zeros(n, dtype=bool)
+        hit_tile = np.zeros(n, dtype=int)
+        for k in range(count.max()):
+            todo = (k < count) & ~hit
+            if not todo.any():
+                break
+            tile = first + k * step
+            solid = np.zeros(n, dtype=bool)
+            for j in range(span.max()):
+                other = first_across + j
+                if axis == 0:
+                    solid |= self.solid(tile, other) & (j < span)
+                else:
+                    solid |= self.solid(other, tile) & (j < span)
+            solid &= todo
+            hit_tile[solid] = tile[solid]
+            hit |= solid
+
+        before = hit & forward
+        after = hit & ~forward
+        target[before] = hit_tile[before] * st.TILESIZE - size[before]
+        target[after] = (hit_tile[after] + 1) * st.TILESIZE
+        pos[:] = target
+        move[hit] = 0
+        normal = self.normal[:n, axis]
+        normal[before] = -1
+        normal[after] = 1
+
+
+    def collide(self, axis, left, top):
+        '''
+        moves the bodies out of the first tile that they overlap (in the
+        order of fn.Grid.blocks_in_rect) along an axis, like fn.resolve
+        '''
+        n = self.count
+        w = self.size[:n, 0]
+        h = self.size[:n, 1]
+        columns = np.stack((left // st.TILESIZE,
+                            (left + w - 1) // st.TILESIZE), axis=1)
+        rows = np.stack((top // st.TILESIZE,
+                         (top + h - 1) // st.TILESIZE), axis=1)
+        # the (up to) 4 tiles under every body, row by row
+        tile_x = columns[:, [0, 1, 0, 1]]
+        tile_y = rows[:, [0, 0, 1, 1]]
+        solid = self.solid(tile_x, tile_y)
+
+        hit = solid.any(axis=1)
+        if not hit.any():
+            return
+        first = solid.argmax(axis=1)
+        bodies = np.arange(n)
+        if axis == 0:
+            start, size, near = left, w, tile_x[bodies, first] * st.TILESIZE
+        else:
+            start, size, near = top, h, tile_y[bodies, first] * st.TILESIZE
+        pos = self.pos[:n, axis]
+        # hit from before (left or top) or from after (right or bottom)
+        before = hit & (near > start)
+        after = hit & ~before & ((near + st.TILESIZE < start + size)
+                                 if axis == 0 else (near < start))
+        pushed = pos.copy()
+        pos[before] = near[before] - size[before]
+        pos[after] = near[after] + st.TILESIZE
+        self.vel[:n, axis][hit] = 0
+        # (like Physics_object.update, only bodies that were moved)
+        normal = self.normal[:n, axis]
+        normal[pos < pushed] = -1
+        normal[pos > pushed] = 1
@@ -0,0 +1,297 @@
+import pygame as pg
+
+import settings as st
+import tiles as tl
+import streaming
+
+'''
+Drawing of the terrain
+
+the blocks of a sector hardly ever change, so every loaded sector is drawn
+once to its own surface and the game blits these surfaces instead of one
+surface per Block sprite. sprites that move (the player and drops) are
+drawn on top of them
+
+the screen keeps its pixels from one frame to the next, so only the parts
+of it where something changed are drawn again, scaled and sent to the
+display (see Dirty_screen)
+'''
+
+# marks the empty tiles of a sector surface, no block type uses this color
+COLORKEY = (255, 0, 255)
+
+
+
+class Terrain_renderer:
+    '''
+    keeps one baked surface per loaded sector, built from the block IDs
+    of the world map (grid.map_blueprint)
+    a tile edit drops the surface of its sector, which is baked again
+    the next time it is drawn
+    '''
+    def __init__(self, game):
+        self.game = game
+        # (sector_x, sector_y) -> pg.Surface
+        self.surfaces = {}
+        self.bakes = 0
+        # sector -> tiles that changed since the last call of changed_rect,
+        # only for sectors that were drawn
+        self.changed = {}
+        # sectors and sprites that were drawn in the last frame
+        # versus the ones that are loaded
+        self.sectors_drawn = 0
+        self.sectors_loaded = 0
+        self.sprites_drawn = 0
+        self.sprites_loaded = 0
+
+
+    def invalidate(self, grid_x, grid_y):
+        '''
+        the tile at grid_x, grid_y changed
+        '''
+        sector = (grid_x // st.SECTOR_WIDTH, grid_y // st.SECTOR_HEIGHT)
+        if (self.surfaces.pop(sector, None) is not None 
+                or sector in self.changed):
+            self.changed.setdefault(sector, []).append((grid_x, grid_y))
+
+
+    def changed_rect(self, camera):
+        '''
+        returns the rect on the screen around the tiles that changed 
+        since the last call, None if none of them is on the screen
+        '''
+        view = camera.view_rect()
+        rects = [pg.Rect(x * st.TILESIZE, y * st.TILESIZE, 
+                         st.TILESIZE, st.TILESIZE)
+                 for tiles in self.changed.values() for x, y in tiles]
+        self.changed.clear()
+        rects = [rect for rect in rects if rect.colliderect(view)]
+        if not rects:
+            return None
+        return camera.apply_rect(rects[0].unionall(rects))
+
+
+    def bake(self, sector):
+        grid = self.game.grid
+        x0, y0, x1, y1 = streaming.sector_tiles(sector, grid.width,
+                                                grid.height)
+        surf = tl.display_format(pg.Surface(((x1 - x0) * st.TILESIZE,
+                                             (y1 - y0) * st.TILESIZE)))
+        surf.fill(COLORKEY)
+        surf.set_colorkey(COLORKEY, pg.RLEACCEL)
+
+        grid.map_blueprint.load_region(x0, y0, x1, y1)
+        ids = grid.map_blueprint.ids[y0:y1, x0:x1]
+        images = self.game.atlas.blocks
+        surf.blits([(images[tl.block_name(ids[j, i])],
+                     (int(i) * st.TILESIZE, int(j) * st.TILESIZE))
+                    for j, i in zip(*ids.nonzero())], doreturn=False)
+        self.bakes += 1
+        return surf
+
+
+    def draw(self, surface, camera, sectors):
+        '''
+        draws the terrain of the sectors that are on the screen,
+        surfaces of sectors that are not in sectors anymore are thrown away
+        '''
+        for sector in list(self.surfaces):
+            if sector not in sectors:
+                del self.surfaces[sector]
+
+        view = camera.view_rect()
+        sector_w = st.SECTOR_WIDTH * st.TILESIZE
+        sector_h = st.SECTOR_HEIGHT * st.TILESIZE
+        self.sectors_loaded = len(sectors)
+        self.sectors_drawn = 0
+        for sector_x in range(view.left // sector_w, 
+                              (view.right - 1) // sector_w + 1):
+            for sector_y in range(view.top // sector_h, 
+                                  (view.bottom - 1) // sector_h + 1):
+                sector = (sector_x, sector_y)
+                if sector not in sectors:
+                    continue
+                surf = self.surfaces.get(sector)
+                if surf is None:
+                    surf = self.surfaces[sector] = self.bake(sector)
+                surface.blit(surf, (sector_x * sector_w + camera.camera.x,
+                                    sector_y * sector_h + camera.camera.y))
+                self.sectors_drawn += 1
+
+
+    def draw_sprites(self, surface, camera, sprites, alpha=1):
+        '''
+        draws the sprites of a fn.Spatial_hash that are on the screen,
+        between their last two positions (see Physics_object.draw_rect)
+        returns the rects on the surface that were drawn to
+        '''
+        visible = sprites.query(camera.view_rect())
+        rects = [surface.blit(sprite.image, 
+                              camera.apply_rect(sprite.draw_rect(alpha)))
+                 for sprite in visible]
+        self.sprites_drawn = len(visible)
+        self.sprites_loaded = len(sprites)
+        return rects
+                    
+                    
+    def stats(self):
+        return ('drawn: %d/%d sectors, %d/%d sprites' % 
+                (self.sectors_drawn, self.sectors_loaded, 
+                 self.sprites_drawn, self.sprites_loaded))
+
+
+
+class Dirty_screen:
+    '''
+    scales the screen of the game onto the display, but only the parts
+    of it that changed since the last frame
+
+    the map part of the screen (view) is restored from a layer with the
+    background and the terrain where sprites were drawn in the last frame.
+    when the camera moves, the layer, the view and the display are
+    scrolled and only the strips that come into view are drawn. the layer
+    is drawn again when other sectors are loaded, and in the parts where
+    tiles changed
+    '''
+    def __init__(self, game):
+        self.game = game
+        self.screen = game.screen
+        self.display = game.monitor_screen
+        self.scale = st.SCREEN_SCALE
+        self.rect = self.screen.get_rect()
+        # the part of the screen above the GUI, shares its pixels
+        self.view = self.screen.subsurface((0, 0, st.SCREEN_WIDTH, 
+                                            st.SCREEN_HEIGHT))
+        self.layer = tl.display_format(pg.Surface(self.view.get_size()))
+        self.offset = None
+        # how far the view moved in this frame
+        self.scroll = (0, 0)
+        self.sectors = set()
+        # rects of the sprites that were drawn on the view in this frame
+        self.drawn = []
+        # rects of the screen that have to be sent to the display
+        self.dirty = []
+        # the layer has to be drawn again
+        self.rebuild = True
+        # the whole screen has to be sent to the display
+        self.full = True
+        # the part of the screen that was sent in the last frame (0 to 1)
+        self.updated = 0
+
+
+    def invalidate(self):
+        '''
+        something else was drawn on the screen, the next frame is 
+        drawn completely
+        '''
+        self.rebuild = True
+        self.full = True
+
+
+    def draw_layer(self, camera, background, background_pos, sectors, 
+                   area=None):
+        # (the background is one color, so it doesn't matter that it
+        # moves with the player and not with the camera)
+        self.layer.set_clip(area)
+        self.layer.blit(background, background_pos)
+        self.game.terrain.draw(self.layer, camera, sectors)
+        self.layer.set_clip(None)
+
+
+    def draw_world(self, camera, background, background_pos, sectors):
+        '''
+        draws the background and the terrain on the view, sprites are 
+        drawn on top of it with add()
+        '''
+        offset = tuple(camera.camera.topleft)
+        changed = self.game.terrain.changed_rect(camera)
+        w, h = self.view.get_size()
+        dx = dy = 0
+        if self.offset:
+            dx = offset[0] - self.offset[0]
+            dy = offset[1] - self.offset[1]
+        if (self.rebuild or sectors != self.sectors 
+                or abs(dx) >= w or abs(dy) >= h):
+            self.offset = offset
+            self.sectors = set(sectors)
+            self.draw_layer(camera, background, background_pos, sectors)
+            self.view.blit(self.layer, (0, 0))
+            self.rebuild = False
+            self.full = True
+        else:
+            # remove the sprites of the last frame
+            restore = self.drawn
+            if (dx, dy) != (0, 0):
+                self.offset = offset
+                self.scroll = (dx, dy)
+                self.layer.scroll(dx, dy)
+                self.view.scroll(dx, dy)
+                # the strips that came into view
+                strips = []
+                if dx:
+                    strips.append(pg.Rect(0 if dx > 0 else w + dx, 0, 
+                                          abs(dx), h))
+                if dy:
+                    strips.append(pg.Rect(0, 0 if dy > 0 else h + dy, 
+                                          w, abs(dy)))
+                for area in strips:
+                    self.draw_layer(camera, background, background_pos, 
+                                    sectors, area)
+                restore = [rect.move(dx, dy) for rect in restore] + strips
+            if changed:
+                self.draw_layer(camera, background, background_pos, sectors,
+                                changed)
+                restore.append(changed)
+            for rect in restore:
+                self.view.blit(self.layer, rect, rect)
+            self.dirty.extend(restore)
+        self.drawn = []
+
+
+    def add(self, rects, restore=True):
+        '''
+        rects were drawn on the screen in this frame, with restore they 
+        are on the view and are removed again in the next frame
+        '''
+        rects = [rect for rect in rects if rect]
+        self.dirty.extend(rects)
+        if restore:
+            self.drawn.extend(rects)
+
+
+    def present(self):
+        '''
+        scales the dirty rects of the screen onto the display and 
+        updates them
+        '''
+        area = sum(rect.w * rect.h for rect in self.dirty)
+        # (rects can overlap, then the whole screen is faster)
+        if self.full or area >= self.rect.w * self.rect.h:
+            pg.transform.scale(self.screen, self.display.get_size(), 
+                               self.display)
+            pg.display.update()
+            self.updated = 1
+        else:
+            s = self.scale
+            rects = []
+            if self.scroll != (0, 0):
+                # everything on the view moved on the display as well
+                view = pg.Rect(0, 0, self.view.get_width() * s,
+                               self.view.get_height() * s)
+                self.display.subsurface(view).scroll(self.scroll[0] * s,
+                                                     self.scroll[1] * s)
+                rects.append(view)
+            for rect in self.dirty:
+                rect = rect.clip(self.rect)
+                if not rect:
+                    continue
+                scaled = pg.Rect(rect.x * s, rect.y * s, 
+                                 rect.w * s, rect.h * s)
+                pg.transform.scale(self.screen.subsurface(rect), scaled.size,
+                                   self.display.subsurface(scaled))
+                rects.append(scaled)
+            pg.display.update(rects)
+            self.updated = area / (self.rect.w * self.rect.h)
+        self.dirty = []
+        self.full = False
+        self.scroll = (0, 0)
@@ -0,0 +1,159 @@
+import numpy as np
+
+import settings as st
+import tiles as tl
+import streaming
+
+'''
+Falling tiles (like sand) on the world map
+
+falling tiles are not simulated as sprites, every step moves all of them
+that have an empty tile below down by one tile, with numpy on the block
+IDs of the world map. only the sectors where a tile changed since the
+last steps are simulated, afterwards the Block sprites, the edit journal
+and the baked terrain are updated for the tiles that changed
+'''
+
+
+
+class Sand_simulation:
+    def __init__(self, grid, interval=st.SAND_STEP_TICKS):
+        self.grid = grid
+        # ticks per step
+        self.interval = interval
+        self.tick = 0
+        # sectors that have to be simulated
+        self.dirty = set()
+        # tiles that were moved since the start
+        self.moved = 0
+
+
+    def mark(self, grid_x, grid_y):
+        '''
+        a tile changed, the tiles above it may fall now
+        '''
+        sector_x = grid_x // st.SECTOR_WIDTH
+        sector_y = grid_y // st.SECTOR_HEIGHT
+        self.mark_sector((sector_x, sector_y))
+        if grid_y % st.SECTOR_HEIGHT == 0:
+            # the top row of a sector holds up the sector above it
+            self.mark_sector((sector_x, sector_y - 1))
+
+
+    def mark_sector(self, sector):
+        if sector[1] >= 0:
+            self.dirty.add(sector)
+
+
+    def update(self):
+        self.tick += 1
+        if self.tick % self.interval == 0:
+            self.step()
+
+
+    def step(self):
+        '''
+        moves the falling tiles of the dirty sectors one tile down,
+        sectors without any movement are not dirty anymore
+        '''
+        loaded = self.grid.streamer.loaded
+        # lower sectors go first, so that a column of falling tiles that
+        # reaches into the sector below falls as a whole. a sector above
+        # that becomes dirty is simulated in the same step, one below 
+        # in the next step
+        done = set()
+        row = None
+        while True:
+            todo = [sector for sector in self.dirty - done
+                    if row is None or sector[1] <= row]
+            if not todo:
+                break
+            sector = max(todo, key=lambda sector: sector[1])
+            row = sector[1]
+            done.add(sector)
+            if sector not in loaded or not self.step_sector(sector):
+                self.dirty.discard(sector)
+
+
+    def step_sector(self, sector):
+        '''
+        returns True if any tile of the sector moved
+        '''
+        grid = self.grid
+        x0, y0, x1, y1 = streaming.sector_tiles(sector, grid.width,
+                                                grid.height)
+        bottom = y1
+        below = (sector[0], sector[1] + 1)
+        if below in self.grid.streamer.loaded:
+            # tiles can fall into the top row of the sector below
+            bottom += 1
+        tiles = grid.map_blueprint.ids[y0:bottom, x0:x1]
+        h = bottom - y0
+
+        falls = tl.FALLS[tiles]
+        # for every tile the row of the first tile at or below it
+        # that doesn't fall (h if there is none)
+        rows = np.arange(h).reshape(h, 1)
+        stop = np.where(falls, h, rows)
+        stop = np.minimum.accumulate(stop[::-1], axis=0)[::-1]
+        # a tile falls if the column of falling tiles it belongs to
+        # has an empty tile below it
+        landing = tiles == tl.EMPTY
+        landing &= ~self.occupied(x0, y0, x1, bottom)
+        landing = np.vstack((landing, np.zeros((1, x1 - x0), dtype=bool)))
+        moving = falls & np.take_along_axis(landing, stop, axis=0)
+        moving[y1 - y0:] = False
+        if not moving.any():
+            return False
+
+        new = tiles.copy()
+        new[moving] = tl.EMPTY
+        new[1:][moving[:-1]] = tiles[:-1][moving[:-1]]
+        changed = (new != tiles).nonzero()
+        tiles[:] = new
+
+        self.move_blocks(x0, y0, moving)
+        for j, i in zip(*changed):
+            self.changed(x0 + int(i), y0 + int(j))
+        self.moved += int(moving.sum())
+        return True
+
+
+    def occupied(self, x0, y0, x1, y1):
+        '''
+        returns a bool array of the tiles x0 <= x < x1, y0 <= y < y1
+        that tiles can't fall into because the player is there
+        '''
+        occupied = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        rect = self.grid.game.player.rect
+        occupied[max(0, rect.top // st.TILESIZE - y0):
+                 max(0, (rect.bottom - 1) // st.TILESIZE + 1 - y0),
+                 max(0, rect.left // st.TILESIZE - x0):
+                 max(0, (rect.right - 1) // st.TILESIZE + 1 - x0)] = True
+        return occupied
+
+
+    def move_blocks(self, x0, y0, moving):
+        '''
+        moves the Block sprites of the moving tiles one tile down
+        '''
+        grid = self.grid
+        rows, columns = moving.nonzero()
+        # the lowest tiles first, they make room for the ones above
+        for j, i in zip(rows[::-1], columns[::-1]):
+            key = (x0 + int(i), y0 + int(j))
+            block = grid.map.pop(key, None)
+            if block:
+                block.pos.y += st.TILESIZE
+                block.rect.topleft = block.pos
+                grid.map[(key[0], key[1] + 1)] = block
+
+
+    def changed(self, grid_x, grid_y):
+        grid = self.grid
+        if grid.journal:
+            grid.journal.append(grid_x, grid_y,
+                                grid.map_blueprint.ids[grid_y, grid_x])
+        grid.game.terrain.invalidate(grid_x, grid_y)
+        grid.wake(grid_x, grid_y)
+        self.mark(grid_x, grid_y)
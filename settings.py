@@ -3,6 +3,14 @@ from os import path
 SCREEN_SCALE = 2
 SCREEN_WIDTH = 800 // SCREEN_SCALE
 SCREEN_HEIGHT = 600 // SCREEN_SCALE
+# frames per second
+FPS = 60
+# simulation ticks per second, independent of the frame rate
+TICK_RATE = 60
+# a slow frame is followed by at most this many ticks to catch up, 
+# the rest of the time is dropped (the game slows down instead of
+# falling further and further behind)
+MAX_CATCH_UP_TICKS = 5
 
 directory = path.dirname(__file__)
 IMAGE_FOLDER = path.join(directory, 'images')
@@ -12,12 +20,67 @@ TILESIZE_SQUARED = TILESIZE ** 2
 MAP_WIDTH = 280 * TILESIZE
 MAP_HEIGHT = 100 * TILESIZE
 GUI_HEIGHT = 3 * TILESIZE
+DROP_SIZE = 10
+# in pixels per tick, collisions are swept so any speed works
+# (falling at MAX_FALL_SPEED + 1 or faster is set back to MAX_FALL_SPEED)
+MAX_FALL_SPEED = TILESIZE // 2 - 1
+# drops of the same type closer than this (in pixels) form one stack
+DROP_STACK_DISTANCE = TILESIZE
 SECTOR_WIDTH = 14
 SECTOR_HEIGHT = 10
 #SECTOR_WIDTH = 10
 #SECTOR_HEIGHT = 10
 NO_SECTORS_W = MAP_WIDTH // (SECTOR_WIDTH * TILESIZE)
 NO_SECTORS_H = MAP_HEIGHT // (SECTOR_HEIGHT * TILESIZE)
+# Block sprites are loaded for the sectors within this many sectors
+# of the player's sector
+LOAD_RADIUS = 1
+# sectors the player will reach within this many ticks (at the current
+# velocity) are built ahead of time, with at most PREFETCH_BUDGET_MS
+# milliseconds per tick
+PREFETCH_TICKS = 30
+PREFETCH_BUDGET_MS = 3
+# unloaded Block sprites that are kept for reuse
+BLOCK_POOL_SIZE = 2000
+# falling tiles like sand fall one tile every SAND_STEP_TICKS ticks
+SAND_STEP_TICKS = 2
+# cell size in pixels of the spatial hash of the moving sprites
+HASH_CELL_SIZE = 4 * TILESIZE
+# random tiles per loaded sector and tick that can grow (see growth.py),
+# dirt turns into grass after GRASS_GROWTH_TICKS ticks on average
+RANDOM_TICKS_PER_SECTOR = 3
+GRASS_GROWTH_TICKS = 600
+# None generates a different world every time
+WORLD_SEED = None
+# generate sectors when they are first loaded instead of the whole map
+# at the start, makes the start time independent of MAP_WIDTH
+CHUNKED_WORLD = False
+# the world is saved to this file on quit and loaded from it on start,
+# delete it to generate a new world
+WORLD_FILE = 'world.dat'
+# seconds between writes of the edit journal (the edits that a crash loses)
+JOURNAL_FLUSH_INTERVAL = 1
+# seconds between rewrites of the world file with the edits of the journal
+JOURNAL_COMPACT_INTERVAL = 30
+# world sizes in tiles for generate_world.py
+# workers: processes for world generation, None uses all cores
+WORLD_PRESETS = {
+        'small': {
+                'width': 280,
+                'height': 100,
+                'workers': 1
+                },
+        'large': {
+                'width': 2800,
+                'height': 1000,
+                'workers': None
+                },
+        'huge': {
+                'width': 8400,
+                'height': 2000,
+                'workers': None
+                },
+        }
 
 
 WHITE = (255, 255, 255)
@@ -46,7 +109,9 @@ BLOCK_TYPES = {
                 }, 
         'sand': {
                 'color': YELLOW,
-                'hardness': 1
+                'hardness': 1,
+                # falls down if there is nothing below it (see sand.py)
+                'falls': True
                 }, 
         'stone': {
                 'color': DARKGREY,
@@ -9,6 +9,20 @@ GRAVITY = vec(0, 1)
 NULL = vec(0, 0)
 
 
+def body_vector(name):
+    '''
+    a vec attribute that is stored in the arrays of game.bodies
+    (see physics.Body_store), reading it returns a copy
+    '''
+    def get(self):
+        return vec(tuple(getattr(self.bodies, name)[self.index]))
+    
+    def set(self, value):
+        getattr(self.bodies, name)[self.index] = tuple(value)
+        
+    return property(get, set)
+
+
 class Physics_object(pg.sprite.Sprite):
     '''
     parent sprite for all sprites that experience physics
@@ -18,28 +32,52 @@ class Physics_object(pg.sprite.Sprite):
         self.pos = vec(0, 0)
         self.acc = vec(0, 0)
         self.vel = vec(0, 0)
+        # position at the start of the last tick, for drawing
+        self.last_pos = vec(0, 0)
         self.rect = self.image.get_rect()
         self.rect.topleft = self.pos
         
         self.speed = 0.5
         self.friction = -0.12
         self.gravity = vec(GRAVITY)
+        # normal of the sides of the blocks that were hit in the last tick,
+        # (0, -1) is standing on a block
+        self.normal = vec(0, 0)
+        
+        
+    def draw_rect(self, alpha):
+        '''
+        returns the rect of the sprite moved back towards its position
+        before the last tick, alpha is how far it is into the next tick 
+        (0 to 1)
+        '''
+        offset = (self.last_pos - self.pos) * (1 - alpha)
+        return self.rect.move(round(offset.x), round(offset.y))
+    
+    
+    def begin_tick(self):
+        self.last_pos.update(self.pos)
         
         
-    def update(self, others):        
+    def update(self):        
         self.acc += self.gravity
 
         self.vel += 0.5 * self.acc
         # cap falling speed
-        if self.vel.y >= st.TILESIZE // 2:
-            self.vel.y = st.TILESIZE // 2 - 1
-        self.pos += self.vel
+        if self.vel.y >= st.MAX_FALL_SPEED + 1:
+            self.vel.y = st.MAX_FALL_SPEED
         self.acc *= 0
-        # collision detection
-        self.rect.left = self.pos.x
-        fn.collide(self, others, 'x')
-        self.rect.top = self.pos.y
-        fn.collide(self, others, 'y')
+        # move along x, then along y, and stop at the first block on the way
+        # (collide_grid pushes the sprite out of blocks that were placed
+        # where it is)
+        grid = self.game.grid
+        self.rect.topleft = self.pos
+        self.normal.update(0, 0)
+        for axis, dir_ in ((0, 'x'), (1, 'y')):
+            self.normal[axis] = fn.sweep(self, grid, axis)
+            start = self.pos[axis]
+            if fn.collide_grid(self, grid, dir_) and self.pos[axis] != start:
+                self.normal[axis] = 1 if self.pos[axis] > start else -1
 
         # kill if not in bounds
         if not - st.TILESIZE < self.pos.x < st.MAP_WIDTH + st.TILESIZE:
@@ -57,7 +95,9 @@ class Player(Physics_object):
         self.image.fill(st.RED)
         super().__init__()
         self.game.all_sprites.add(self)
+        self.game.active.add(self)
         self.pos = vec(x, y)
+        self.last_pos = vec(self.pos)
         
         self.speed = 0.5
         self.friction = -0.2
@@ -69,7 +109,7 @@ class Player(Physics_object):
         self.reach = 60
         
         
-    def update(self, others):
+    def update(self):
         pressed = pg.key.get_pressed()
         move_left = pressed[pg.K_a]
         move_right = pressed[pg.K_d]
@@ -78,7 +118,7 @@ class Player(Physics_object):
         self.acc.x *= self.speed  
         self.acc.x += self.vel.x * self.friction
         
-        super().update(others)
+        super().update()
        
         # Add and remove blocks
         if self.game.mouseclickedleft:
@@ -101,11 +141,9 @@ class Player(Physics_object):
         self.inventory_types = list(self.inventory)       
         
         
-    def jump(self, blocks):
-        self.rect.y += 1
-        hits = pg.sprite.spritecollide(self, blocks, False)
-        self.rect.y -= 1
-        if hits:
+    def jump(self):
+        # only from the ground
+        if self.normal.y < 0:
             self.vel.y = -10
 
         
@@ -115,79 +153,75 @@ class Player(Physics_object):
 
 
 class Block(Physics_object):
-    def __init__(self, game, type_, x, y):
+    def __init__(self, game, type_, x, y, add_to_groups=True):
+        # without add_to_groups the block is built ahead of time and 
+        # added to the groups later (see streaming.Sector_streamer)
         self.game = game
-        self.type = type_
-        if 'image' in st.BLOCK_TYPES[self.type]:
-            image_no = st.BLOCK_TYPES[self.type]['image']
-            self.image = self.game.image_loader.blocks[image_no]
-        else:
-            self.image = pg.Surface((st.TILESIZE, st.TILESIZE))
-            self.image.fill(st.BLOCK_TYPES[self.type]['color'])
+        self.image = self.game.atlas.blocks[type_]
         super().__init__()
-        self.game.all_sprites.add(self)
-        self.game.blocks.add(self)
+        if add_to_groups:
+            self.game.all_sprites.add(self)
+            self.game.blocks.add(self)
         self.grid = self.game.grid
-        self.pos = vec(x, y)
+        self.reset(type_, x, y)
+        
+        
+    def reset(self, type_, x, y):
+        '''
+        turns the block into a new block of type_ at x, y
+        (unloaded blocks are reused, see streaming.Block_pool)
+        '''
+        self.type = type_
+        self.image = self.game.atlas.blocks[self.type]
+        self.pos.update(x, y)
+        self.vel.update(0, 0)
+        self.acc.update(0, 0)
         self.rect.topleft = self.pos
+        self.gravity.update(GRAVITY)
 
         self.hardness = st.BLOCK_TYPES[self.type]['hardness']
-        
-        self.state = 'STATIC'
-        self.age = 0
-    
-    
-    def update(self, others):
-        if self.type == 'dirt':
-            # check if nothing is above on the map
-            if (not self.grid.get_at((self.pos.x, self.pos.y - st.TILESIZE))
-                and not self.grid.get_at((self.pos.x, 
-                                             self.pos.y + st.TILESIZE)) == None):
-                self.age += 1
-                if self.age >= 600:
-                    self.type = 'grass'
-                    self.image.fill(st.BLOCK_TYPES[self.type]['color'])
-                    self.age = 0
-        
-        if self.type == 'sand':
-            # sands experiences gravity if no block is below it
-            if (self.grid.get_at((self.pos.x, self.pos.y + st.TILESIZE))
-                and self.state == 'STATIC'):
-                return
-            else:                
-                super().update(others)
-                                
-                if self.vel.length_squared() == 0:
-                    self.state = 'STATIC'
-                else:
-                    if self.state == 'STATIC':
-                        self.game.grid.remove_at(self.pos)
-                        self.state = 'MOVING'
-                
-                if self.state == 'STATIC':
-                    if not self.game.grid.get_at(self.pos):
-                        self.game.grid.block_add(self.pos, self)
-        
-        
-        def draw(self, surface):
-            surface.blit(self.image, self.rect.topleft)
 
 
     
 class Block_drop(Physics_object):
+    # the physics of all drops is done at once by game.bodies
+    pos = body_vector('pos')
+    last_pos = body_vector('last')
+    vel = body_vector('vel')
+    acc = body_vector('acc')
+    gravity = body_vector('gravity')
+    normal = body_vector('normal')
+    
     def __init__(self, game, type_, pos):
         self.game = game
         self.type = type_
-        self.image = pg.Surface((10, 10))
-        self.image.fill(st.BLOCK_TYPES[self.type]['color'])
+        # number of blocks in this stack
+        self.count = 1
+        self.image = self.game.atlas.drops[self.type]
+        self.bodies = self.game.bodies
+        self.index = self.bodies.add(self, self.image.get_size())
         super().__init__()
-        self.game.all_sprites.add(self)
-        self.game.drops.add(self)        
         self.pos = vec(pos)
+        self.last_pos = vec(self.pos)
         self.rect.topleft = self.pos
+        self.game.all_sprites.add(self)
+        self.game.drops.add(self)        
+        self.game.entities.add(self)
+        self.game.active.add(self)
+        
+        
+    def kill(self):
+        if self.alive():
+            self.bodies.remove(self.index)
+        super().kill()
+        
+        
+    def begin_tick(self):
+        # game.bodies keeps the last positions
+        pass
 
     
-    def update(self, others):
+    def update(self):
         '''
         # if not in camera range, kill
         rect = pg.Rect((0, 0), (st.SCREEN_WIDTH, st.SCREEN_HEIGHT))
@@ -195,13 +229,12 @@ class Block_drop(Physics_object):
         if not self.rect.colliderect(rect):
             self.kill()
             return'''
+        if not self.alive():
+            # taken into another stack earlier in this tick
+            return
         
-        # apply physics
-        # exclude player from collision
+        # physics was already applied by game.bodies
         player = self.game.player 
-        sprites = [other for other in others if (other != player and 
-                                            not isinstance(other, Block_drop))]
-        super().update(sprites)
                     
         # object is drawn towards player
         self_to_player = player.rect.center - self.pos  
@@ -210,29 +243,50 @@ class Block_drop(Physics_object):
             self.pos += self_to_player.normalize() * 2
         else:
             self.gravity = GRAVITY                 
+            if self.normal.y < 0:
+                # lying on the ground, the player or game.bodies
+                # wake it up
+                self.game.active.remove(self)
         
         # check for collision with player
         if pg.sprite.collide_rect(self, player):
             self.kill()
             if self.type in player.inventory:
-                player.inventory[self.type] += 1
+                player.inventory[self.type] += self.count
             else:
-                player.inventory[self.type] = 1
+                player.inventory[self.type] = self.count
+            return
         
-        self.seperate()
+        distance = st.DROP_STACK_DISTANCE
+        neighbors = self.game.entities.query(self.rect.inflate(2 * distance, 
+                                                               2 * distance))
+        self.stack(neighbors)
+        self.seperate(neighbors)
+        
+        
+    def stack(self, neighbors):
+        # take the drops of the same type close to this one
+        pos = self.pos
+        for drop in neighbors:
+            if (drop is not self and isinstance(drop, Block_drop) 
+                    and drop.type == self.type
+                    and (pos - drop.pos).length_squared() 
+                    <= st.DROP_STACK_DISTANCE ** 2):
+                self.count += drop.count
+                drop.kill()
         
     
-    def seperate(self):
+    def seperate(self, neighbors):
         # seperate the block drops if they fall onto each other
-        if len(self.game.drops) <= 1:
-            return
-        for drop in self.game.drops:
-            if drop != self:
-                dist = self.pos - drop.pos
-                
-        if 0 < dist.length_squared() < 25:
-            # if they are less than 5 pixels apart, change their position
-            self.pos += dist.normalize()  
+        pos = self.pos
+        for drop in neighbors:
+            if drop is self or not drop.alive():
+                continue
+            dist = pos - drop.pos
+            if 0 < dist.length_squared() < 25:
+                # if they are less than 5 pixels apart, change their position
+                pos += dist.normalize()  
+        self.pos = pos
             
 class GUI:
     def __init__(self, game):
@@ -243,48 +297,73 @@ class GUI:
         self.pos = vec(0, st.SCREEN_HEIGHT)
         self.rect.topleft = self.pos 
         self.font = pg.font.SysFont('Arial', 12)
+        # the inventory that is drawn on self.surf
+        self.shown = None
     
     
-    def draw(self):
-        screen = self.game.screen
-        screen.blit(self.surf, self.rect)
+    def draw(self, full=False):
+        '''
+        draws the GUI on the screen if the inventory changed (or with full)
+        returns the rect that was drawn to or None
+        '''
+        player = self.game.player
+        shown = (tuple(player.inventory.items()), player.inventory_selected,
+                 len(player.inventory_types))
+        if shown == self.shown and not full:
+            return None
+        if shown != self.shown:
+            self.render(player)
+            self.shown = shown
+        return self.game.screen.blit(self.surf, self.rect)
         
+        
+    def render(self, player):
+        surf = self.surf
+        surf.fill(st.BLACK)
         # draw blocks:
-        player = self.game.player
         for i, key in enumerate(player.inventory):
             color = st.BLOCK_TYPES[key]['color']
-            rect = pg.Rect((st.TILESIZE + i * st.TILESIZE * 3, 
-                            st.SCREEN_HEIGHT + st.TILESIZE), 
+            rect = pg.Rect((st.TILESIZE + i * st.TILESIZE * 3, st.TILESIZE), 
                            (st.TILESIZE, st.TILESIZE))
-            pg.draw.rect(screen, color, rect)
+            pg.draw.rect(surf, color, rect)
             # draw amount
             text = ' x ' + str(player.inventory[key])
             text_surf = self.font.render(text, False, st.WHITE)
-            screen.blit(text_surf, (2 * st.TILESIZE + i * st.TILESIZE * 3,
-                                    st.SCREEN_HEIGHT + st.TILESIZE))
+            surf.blit(text_surf, (2 * st.TILESIZE + i * st.TILESIZE * 3,
+                                  st.TILESIZE))
         
-        rect = pg.Rect((st.TILESIZE + self.game.player.inventory_selected 
-                        * st.TILESIZE * 3, 
-                       st.SCREEN_HEIGHT + st.TILESIZE), 
-                           (st.TILESIZE, st.TILESIZE))
-        if len(self.game.player.inventory_types) > 0:
-            pg.draw.rect(screen, st.WHITE, rect, 2)
+        rect = pg.Rect((st.TILESIZE + player.inventory_selected 
+                        * st.TILESIZE * 3, st.TILESIZE), 
+                       (st.TILESIZE, st.TILESIZE))
+        if len(player.inventory_types) > 0:
+            pg.draw.rect(surf, st.WHITE, rect, 2)
             
     
     def draw_loading_screen(self):
+        grid = self.game.grid
+        progress = grid.progress()
+        pct = int(progress * 100)
+        pg.display.set_caption('Loading map: ' + str(pct) + ' %')
         self.game.screen.fill(st.BLACK)
-        step = self.game.grid.step - 1
-        pct = int(step / self.game.grid.no_of_steps * 100)
-        text = 'Creating world map: %4d %% '% pct + '|||||' * step + '     ' * (5 - step) + '|'
-        text_surf = self.font.render(text, False, st.WHITE)
-        self.game.screen.blit(text_surf,
-                              (st.SCREEN_WIDTH // 4, st.SCREEN_HEIGHT // 2))
-                              
-        transformed_screen = pg.transform.scale(self.game.screen, 
-                                    (self.game.monitor_screen.get_width(),
-                                    self.game.monitor_screen.get_height()))
-        self.game.monitor_screen.blit(transformed_screen, (0, 0))
-        pg.display.update()
+        x = st.SCREEN_WIDTH // 4
+        y = st.SCREEN_HEIGHT // 2
+        if self.game.generation_cancelled:
+            lines = ['World generation cancelled',
+                     'Press ENTER to start again']
+        else:
+            lines = ['Creating world map: %4d %%' % pct,
+                     '%d cells  (ESC to cancel)' % grid.cells_done]
+            # progress bar
+            bar = pg.Rect(x, y + 2 * st.TILESIZE, st.SCREEN_WIDTH // 2, 8)
+            pg.draw.rect(self.game.screen, st.WHITE, bar, 1)
+            bar.w = int(bar.w * progress)
+            pg.draw.rect(self.game.screen, st.WHITE, bar)
+        for i, text in enumerate(lines):
+            text_surf = self.font.render(text, False, st.WHITE)
+            self.game.screen.blit(text_surf, (x, y + i * st.TILESIZE))
+        
+        self.game.display.invalidate()
+        self.game.display.present()
         
 
         
\ No newline at end of file
@@ -0,0 +1,243 @@
+from time import perf_counter
+
+import sprites as spr
+import settings as st
+import tiles as tl
+
+'''
+Loading and unloading of Block sprites around the player
+'''
+
+
+
+def sector_at(pos):
+    '''
+    returns (sector_x, sector_y) of a position in pixels
+    '''
+    return (int(pos[0] // (st.SECTOR_WIDTH * st.TILESIZE)),
+            int(pos[1] // (st.SECTOR_HEIGHT * st.TILESIZE)))
+
+
+def sector_tiles(sector, width, height):
+    '''
+    returns the tile range x0, y0, x1, y1 of a sector
+    '''
+    x0 = sector[0] * st.SECTOR_WIDTH
+    y0 = sector[1] * st.SECTOR_HEIGHT
+    return (x0, y0, min(x0 + st.SECTOR_WIDTH, width),
+            min(y0 + st.SECTOR_HEIGHT, height))
+
+
+
+class Block_pool:
+    '''
+    keeps the Block sprites of unloaded sectors to reuse them for the
+    next sectors that are loaded instead of creating new ones
+    '''
+    def __init__(self, game, max_size=st.BLOCK_POOL_SIZE):
+        self.game = game
+        self.max_size = max_size
+        self.free = []
+        self.hits = 0
+        self.misses = 0
+
+
+    def acquire(self, type_, x, y):
+        '''
+        returns a Block that is not in any group yet
+        '''
+        if self.free:
+            self.hits += 1
+            block = self.free.pop()
+            block.reset(type_, x, y)
+            return block
+        self.misses += 1
+        return spr.Block(self.game, type_, x, y, add_to_groups=False)
+
+
+    def release(self, blocks):
+        '''
+        removes the blocks from the game and keeps them for later
+        '''
+        self.game.all_sprites.remove(*blocks)
+        self.game.blocks.remove(*blocks)
+        self.free.extend(blocks[:self.max_size - len(self.free)])
+
+
+    def size(self):
+        return len(self.free)
+
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0
+        return self.hits / total
+
+
+
+class Sector_streamer:
+    '''
+    keeps the Block sprites of all sectors within radius sectors of the
+    player loaded
+
+    every time the player changes sectors, the set of sectors that should
+    be loaded is compared to the set that is loaded, and only the
+    difference is loaded and unloaded. this works for moves of any size
+    and direction
+
+    the sectors the player is heading to (by velocity) are built a few
+    blocks per tick before the player gets there, so that crossing a
+    sector border only has to add the finished blocks to the game
+    '''
+    def __init__(self, grid, radius=st.LOAD_RADIUS,
+                 prefetch_ticks=st.PREFETCH_TICKS,
+                 budget_ms=st.PREFETCH_BUDGET_MS):
+        self.grid = grid
+        self.radius = radius
+        self.prefetch_ticks = prefetch_ticks
+        self.budget = budget_ms / 1000
+        self.sectors_w = -(-grid.width // st.SECTOR_WIDTH)
+        self.sectors_h = -(-grid.height // st.SECTOR_HEIGHT)
+        # the sector of the player at the last update
+        self.sector = None
+        self.loaded = set()
+        # sectors that are being built: sector -> iterator over the
+        # blocks that are left and list of (key, Block) that are built
+        self.todo = {}
+        self.built = {}
+        # loaded sectors that were complete or only partly built in advance
+        self.prefetch_hits = 0
+        self.prefetch_misses = 0
+        self.pool = Block_pool(grid.game)
+
+
+    def required(self, sector):
+        sector_x, sector_y = sector
+        return {(x, y)
+                for x in range(max(0, sector_x - self.radius),
+                               min(self.sectors_w, sector_x + self.radius + 1))
+                for y in range(max(0, sector_y - self.radius),
+                               min(self.sectors_h, sector_y + self.radius + 1))}
+
+
+    def update(self, pos, vel=(0, 0)):
+        sector = sector_at(pos)
+        if sector != self.sector:
+            self.sector = sector
+            required = self.required(sector)
+            for old in self.loaded - required:
+                self.unload_sector(old)
+            for new in required - self.loaded:
+                self.load_sector(new)
+            self.loaded = required
+
+        # the sectors on the way to where the player will be 
+        # in prefetch_ticks ticks (vel is in pixels per tick)
+        ahead = set()
+        for ticks in (self.prefetch_ticks // 2, self.prefetch_ticks):
+            ahead |= self.required(sector_at((pos[0] + vel[0] * ticks,
+                                              pos[1] + vel[1] * ticks)))
+        self.prefetch(ahead - self.loaded)
+
+
+    def prefetch(self, sectors):
+        '''
+        builds the blocks of the sectors that will be loaded soon,
+        until the time budget of this tick is used up
+        '''
+        # the player changed direction
+        for sector in list(self.todo):
+            if sector not in sectors:
+                del self.todo[sector]
+                self.pool.release([block for key, block 
+                                   in self.built.pop(sector)])
+
+        deadline = perf_counter() + self.budget
+        for sector in sectors:
+            if not self.build(sector, deadline):
+                break
+
+
+    def sector_blocks(self, sector):
+        '''
+        returns (key, type) of all blocks in a sector
+        '''
+        grid = self.grid
+        x0, y0, x1, y1 = sector_tiles(sector, grid.width, grid.height)
+        grid.map_blueprint.load_region(x0, y0, x1, y1)
+        ids = grid.map_blueprint.ids[y0:y1, x0:x1]
+        return [((x0 + int(i), y0 + int(j)), tl.block_name(ids[j, i]))
+                for j, i in zip(*ids.nonzero())]
+
+
+    def build(self, sector, deadline=None):
+        '''
+        builds the blocks of a sector without adding them to the game,
+        stops at the deadline and continues with the next call
+        returns True when all blocks of the sector are built
+        '''
+        if sector not in self.todo:
+            self.todo[sector] = iter(self.sector_blocks(sector))
+            self.built[sector] = []
+        built = self.built[sector]
+        for key, type_ in self.todo[sector]:
+            built.append((key, self.pool.acquire(type_, key[0] * st.TILESIZE,
+                                                 key[1] * st.TILESIZE)))
+            if deadline and perf_counter() >= deadline:
+                return False
+        return True
+
+
+    def load_sector(self, sector):
+        if sector in self.todo:
+            self.prefetch_hits += 1
+        else:
+            self.prefetch_misses += 1
+        # finish building the sector if it isn't yet
+        self.build(sector)
+        del self.todo[sector]
+
+        grid = self.grid
+        blocks = []
+        unused = []
+        # growth that the sector missed while it was not loaded
+        grid.random_ticks.catch_up(sector)
+        # the tiles can have changed since the blocks were built
+        types = dict(self.sector_blocks(sector))
+        for key, block in self.built.pop(sector):
+            type_ = types.pop(key, None)
+            if type_ and key not in grid.map:
+                if block.type != type_:
+                    block.reset(type_, block.pos.x, block.pos.y)
+                # place block sprite
+                grid.map[key] = block
+                blocks.append(block)
+            else:
+                unused.append(block)
+        for key, type_ in types.items():
+            if key not in grid.map:
+                block = self.pool.acquire(type_, key[0] * st.TILESIZE,
+                                          key[1] * st.TILESIZE)
+                grid.map[key] = block
+                blocks.append(block)
+        self.pool.release(unused)
+        grid.game.all_sprites.add(*blocks)
+        grid.game.blocks.add(*blocks)
+        # falling tiles of the sector and the one above may fall now
+        grid.sand.mark_sector(sector)
+        grid.sand.mark_sector((sector[0], sector[1] - 1))
+
+
+    def unload_sector(self, sector):
+        grid = self.grid
+        x0, y0, x1, y1 = sector_tiles(sector, grid.width, grid.height)
+        blocks = []
+        for i in range(x0, x1):
+            for j in range(y0, y1):
+                block = grid.map.pop((i, j), None)
+                if block:
+                    blocks.append(block)
+        # remove the block sprites
+        self.pool.release(blocks)
+        grid.random_ticks.unloaded(sector)
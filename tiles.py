@@ -0,0 +1,174 @@
+import pygame as pg
+import numpy as np
+
+import settings as st
+
+'''
+Compact tile storage for the world map
+
+Every tile is stored as a small integer block ID in a contiguous
+numpy array (one byte per tile). ID 0 is an empty tile, the other IDs
+follow the order of st.BLOCK_TYPES.
+'''
+
+# block type registry
+BLOCK_NAMES = [None] + list(st.BLOCK_TYPES)
+BLOCK_IDS = {name: id_ for id_, name in enumerate(BLOCK_NAMES)}
+EMPTY = BLOCK_IDS[None]
+# True for the IDs of blocks that fall down
+FALLS = np.zeros(256, dtype=bool)
+FALLS[[BLOCK_IDS[name] for name, block_type in st.BLOCK_TYPES.items()
+       if block_type.get('falls')]] = True
+
+
+def block_id(type_):
+    return BLOCK_IDS[type_]
+
+
+def block_name(id_):
+    return BLOCK_NAMES[id_]
+
+
+def block_type(id_):
+    '''
+    returns the st.BLOCK_TYPES entry of a block ID
+    '''
+    return st.BLOCK_TYPES[BLOCK_NAMES[id_]]
+
+
+def color_table(background=st.LIGHTBLUE):
+    '''
+    returns an array with the RGB color of every block ID
+    '''
+    colors = np.zeros((len(BLOCK_NAMES), 3), dtype=np.uint8)
+    colors[EMPTY] = background[:3]
+    for id_ in range(1, len(BLOCK_NAMES)):
+        colors[id_] = block_type(id_)['color'][:3]
+    return colors
+
+
+def display_format(surf):
+    # converted surfaces blit faster, but that needs a display
+    if pg.display.get_surface():
+        return surf.convert()
+    return surf
+
+
+
+class Tile_atlas:
+    '''
+    one pre-rendered surface per block type for Blocks and Block_drops,
+    shared by all sprites of that type
+    '''
+    def __init__(self, image_loader=None):
+        self.blocks = {}
+        self.drops = {}
+        for name, block_type in st.BLOCK_TYPES.items():
+            if 'image' in block_type:
+                surf = image_loader.blocks[block_type['image']]
+            else:
+                surf = pg.Surface((st.TILESIZE, st.TILESIZE))
+                surf.fill(block_type['color'])
+            self.blocks[name] = display_format(surf)
+            
+            drop = pg.Surface((st.DROP_SIZE, st.DROP_SIZE))
+            drop.fill(block_type['color'])
+            self.drops[name] = display_format(drop)
+
+
+
+class Tile_map:
+    '''
+    2D array of block IDs indexed with [y, x]
+    reading a single tile returns the block type name (or None),
+    writing accepts a type name (or None) for single tiles and slices
+    use self.ids to work on the whole map as an array
+    
+    with a source the sectors are filled the first time load_region() 
+    asks for them, the source needs a method sector(sector_x, sector_y)
+    that returns the block IDs of that sector
+    '''
+    def __init__(self, width, height, source=None):
+        self.width = width
+        self.height = height
+        # zeroed pages are only allocated by the OS once they are written to
+        self.ids = np.zeros((height, width), dtype=np.uint8)
+        
+        self.source = source
+        sectors_w = -(-width // st.SECTOR_WIDTH)
+        sectors_h = -(-height // st.SECTOR_HEIGHT)
+        self.loaded = np.full((sectors_h, sectors_w), source is None)
+
+
+    def __getitem__(self, index):
+        return BLOCK_NAMES[self.ids[index]]
+
+
+    def __setitem__(self, index, type_):
+        self.ids[index] = BLOCK_IDS[type_]
+
+
+    def filled(self):
+        '''
+        returns a 2D bool array of the tiles that are not empty
+        '''
+        return self.ids != EMPTY
+
+
+    def load_region(self, x0, y0, x1, y1):
+        '''
+        makes sure that all sectors overlapping the tiles 
+        x0 <= x < x1, y0 <= y < y1 are loaded
+        '''
+        sx0 = max(0, x0 // st.SECTOR_WIDTH)
+        sy0 = max(0, y0 // st.SECTOR_HEIGHT)
+        sx1 = max(0, -(-x1 // st.SECTOR_WIDTH))
+        sy1 = max(0, -(-y1 // st.SECTOR_HEIGHT))
+        missing = ~self.loaded[sy0:sy1, sx0:sx1]
+        for sy, sx in zip(*missing.nonzero()):
+            self.load_sector(sx0 + int(sx), sy0 + int(sy))
+    
+    
+    def load_sector(self, sector_x, sector_y):
+        x = sector_x * st.SECTOR_WIDTH
+        y = sector_y * st.SECTOR_HEIGHT
+        self.ids[y:y + st.SECTOR_HEIGHT, 
+                 x:x + st.SECTOR_WIDTH] = self.source.sector(sector_x, sector_y)
+        self.loaded[sector_y, sector_x] = True
+
+
+    def image(self, scale=4, region=None, background=st.LIGHTBLUE):
+        '''
+        returns a pg.Surface with every tile as a scale x scale square
+        region (x, y, w, h) in tiles crops the image, the sectors 
+        in the region are loaded if they aren't
+        returns None if the region has no tiles
+        '''
+        if region:
+            x, y, w, h = region
+            x0, y0 = max(0, x), max(0, y)
+            x1, y1 = min(self.width, x + w), min(self.height, y + h)
+            if x1 <= x0 or y1 <= y0:
+                return None
+        else:
+            x0, y0, x1, y1 = 0, 0, self.width, self.height
+        self.load_region(x0, y0, x1, y1)
+        
+        pixels = color_table(background)[self.ids[y0:y1, x0:x1]]
+        pixels = pixels.repeat(scale, axis=0).repeat(scale, axis=1)
+        size = ((x1 - x0) * scale, (y1 - y0) * scale)
+        return pg.image.frombuffer(pixels.tobytes(), size, 'RGB')
+
+    
+    def loaded_region(self):
+        '''
+        returns (x, y, w, h) in tiles of the box around all loaded sectors
+        '''
+        sectors_y, sectors_x = self.loaded.nonzero()
+        if len(sectors_x) == 0:
+            return (0, 0, 0, 0)
+        x = int(sectors_x.min()) * st.SECTOR_WIDTH
+        y = int(sectors_y.min()) * st.SECTOR_HEIGHT
+        w = (int(sectors_x.max()) + 1) * st.SECTOR_WIDTH - x
+        h = (int(sectors_y.max()) + 1) * st.SECTOR_HEIGHT - y
+        return (x, y, w, h)
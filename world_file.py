@@ -0,0 +1,316 @@
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+
+import settings as st
+import tiles as tl
+
+'''
+Binary world file
+
+layout (little endian):
+    header      magic, version, flags, width, height,
+                sector width, sector height, seed
+    palette     number of block types, then the length and name of each
+                (a chunk stores palette indices, not tl.BLOCK_IDS)
+    chunk index offset, length and encoding of every sector, row by row
+    chunks      the block IDs of every sector, raw or zlib compressed
+
+a world file can be used as the source of a tl.Tile_map, the file is
+memory mapped and only the sectors that are loaded are decoded
+
+edits since the world file was written go to an append only journal
+next to it (see Edit_journal), a record is the x, y and block ID of a tile
+'''
+
+MAGIC = b'TWLD'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIHHQ')
+INDEX = np.dtype([('offset', '<u8'), ('length', '<u4'), ('encoding', 'u1')])
+
+# flags
+CHUNKED = 1
+
+# chunk encodings
+MISSING = 0
+RAW = 1
+ZLIB = 2
+
+JOURNAL_MAGIC = b'TJNL'
+JOURNAL_HEADER = struct.Struct('<4sH')
+RECORD = struct.Struct('<IIB')
+
+
+
+class World_file:
+    '''
+    read only view of a world file
+    fallback is used for the sectors that were never generated
+    (see fn.Chunk_generator)
+    '''
+    def __init__(self, path, fallback=None):
+        self.path = path
+        self.fallback = fallback
+        with open(path, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.read_header()
+        except (struct.error, ValueError, UnicodeDecodeError):
+            self.close()
+            raise
+
+
+    def read_header(self):
+        (magic, version, self.flags, self.width, self.height, sector_w,
+         sector_h, self.seed) = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(self.path + ' is not a world file')
+        if version != VERSION:
+            raise ValueError('unsupported world file version ' + str(version))
+        if (sector_w, sector_h) != (st.SECTOR_WIDTH, st.SECTOR_HEIGHT):
+            raise ValueError('world file has a different sector size')
+        self.chunked = bool(self.flags & CHUNKED)
+
+        # translate the palette of the file to the current block IDs
+        offset = HEADER.size
+        count = self.data[offset]
+        offset += 1
+        self.lookup = np.zeros(256, dtype=np.uint8)
+        for i in range(count):
+            length = self.data[offset]
+            name = self.data[offset + 1:offset + 1 + length].decode()
+            offset += 1 + length
+            if name not in tl.BLOCK_IDS:
+                raise ValueError('unknown block type in world file: ' + name)
+            self.lookup[i + 1] = tl.block_id(name)
+        # the chunks can be copied to a new file as they are
+        ids = np.arange(count + 1)
+        self.same_palette = (count == len(tl.BLOCK_NAMES) - 1
+                             and (self.lookup[:count + 1] == ids).all())
+
+        self.sectors_w = -(-self.width // st.SECTOR_WIDTH)
+        self.sectors_h = -(-self.height // st.SECTOR_HEIGHT)
+        self.index = np.frombuffer(self.data, INDEX,
+                                   self.sectors_w * self.sectors_h, offset)
+        self.index = self.index.reshape(self.sectors_h, self.sectors_w)
+
+
+    def raw_chunk(self, sector_x, sector_y):
+        '''
+        returns the encoding and the stored bytes of a sector
+        '''
+        entry = self.index[sector_y, sector_x]
+        start = int(entry['offset'])
+        return int(entry['encoding']), self.data[start:start +
+                                                 int(entry['length'])]
+
+
+    def sector(self, sector_x, sector_y):
+        encoding, data = self.raw_chunk(sector_x, sector_y)
+        if encoding == MISSING:
+            if self.fallback:
+                return self.fallback.sector(sector_x, sector_y)
+            return tl.EMPTY
+        if encoding == ZLIB:
+            data = zlib.decompress(data)
+        w, h = sector_size(self.width, self.height, sector_x, sector_y)
+        return self.lookup[np.frombuffer(data, np.uint8).reshape(h, w)]
+
+
+    def close(self):
+        # the index is a view into the map and has to go first
+        self.index = None
+        self.data.close()
+
+
+
+def sector_size(width, height, sector_x, sector_y):
+    # sectors at the right and bottom edge can be smaller
+    w = min(st.SECTOR_WIDTH, width - sector_x * st.SECTOR_WIDTH)
+    h = min(st.SECTOR_HEIGHT, height - sector_y * st.SECTOR_HEIGHT)
+    return w, h
+
+
+def save_world(path, tile_map, seed=0, chunked=False, compress=True):
+    '''
+    writes all loaded sectors of a tl.Tile_map to a world file
+    sectors that are not loaded are copied from the world file the
+    tile map was loaded from, or stored as missing
+    '''
+    # write to a temporary file first so that a crash never leaves
+    # a half written world behind
+    temp_path = path + '.tmp'
+    write_world(temp_path, tile_map, seed, chunked, compress)
+    replace_world(temp_path, path, tile_map.source)
+
+
+def replace_world(temp_path, path, source):
+    if isinstance(source, World_file) and source.path == path:
+        # the old file can't be replaced while it is mapped (on Windows)
+        source.close()
+    os.replace(temp_path, path)
+
+
+def encode_chunk(ids, compress=True):
+    data = ids.tobytes()
+    if compress:
+        packed = zlib.compress(data)
+        if len(packed) < len(data):
+            return ZLIB, packed
+    return RAW, data
+
+
+def write_world(path, tile_map, seed=0, chunked=False, compress=True,
+                dirty=None):
+    '''
+    see save_world, but writes to path directly
+    with a set of dirty (sector_x, sector_y), the loaded sectors that are
+    not dirty are copied from the world file the tile map was loaded from
+    (safe to call from a thread while the game keeps changing the map,
+    later changes are in the edit journal)
+    '''
+    if not 0 <= seed < 2 ** 64:
+        raise ValueError('the seed %d does not fit in a world file' % seed)
+    sectors_h, sectors_w = tile_map.loaded.shape
+    source = tile_map.source
+    palette = b''.join(bytes([len(name)]) + name.encode()
+                       for name in tl.BLOCK_NAMES[1:])
+
+    index = np.zeros((sectors_h, sectors_w), dtype=INDEX)
+    chunks = []
+    offset = (HEADER.size + 1 + len(palette) + index.nbytes)
+    for sy in range(sectors_h):
+        for sx in range(sectors_w):
+            loaded = tile_map.loaded[sy, sx]
+            stored = False
+            if (isinstance(source, World_file) 
+                    and source.index[sy, sx]['encoding'] != MISSING):
+                # loaded sectors only have to be written again if they
+                # changed since they were read from the file
+                stored = not loaded or (dirty is not None 
+                                        and (sx, sy) not in dirty)
+            if stored and source.same_palette:
+                # copy the chunk without decoding it
+                encoding, data = source.raw_chunk(sx, sy)
+            elif stored:
+                encoding, data = encode_chunk(source.sector(sx, sy), compress)
+            elif loaded:
+                x = sx * st.SECTOR_WIDTH
+                y = sy * st.SECTOR_HEIGHT
+                encoding, data = encode_chunk(
+                        tile_map.ids[y:y + st.SECTOR_HEIGHT,
+                                     x:x + st.SECTOR_WIDTH], compress)
+            else:
+                encoding, data = MISSING, b''
+            index[sy, sx] = (offset, len(data), encoding)
+            offset += len(data)
+            chunks.append(data)
+
+    header = HEADER.pack(MAGIC, VERSION, CHUNKED if chunked else 0,
+                         tile_map.width, tile_map.height,
+                         st.SECTOR_WIDTH, st.SECTOR_HEIGHT, seed)
+
+    with open(path, 'wb') as file:
+        file.write(header)
+        file.write(bytes([len(tl.BLOCK_NAMES) - 1]))
+        file.write(palette)
+        file.write(index.tobytes())
+        for data in chunks:
+            file.write(data)
+
+
+
+class Edit_journal:
+    '''
+    append only log of the tile edits that are not in the world file yet
+    
+    records are buffered and written by flush(), so a crash loses at most
+    the edits since the last flush. rotate() moves the journal aside 
+    before the world file is rewritten and remove_rotated() deletes it
+    once the new world file is in place
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.rotated_path = path + '.old'
+        self.buffer = bytearray()
+        # sectors with edits since the last rotate()
+        self.dirty = set()
+        self.file = None
+        self.open()
+        
+        
+    def open(self):
+        self.file = open(self.path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, VERSION))
+        
+        
+    def append(self, x, y, id_):
+        self.buffer += RECORD.pack(x, y, id_)
+        self.dirty.add((x // st.SECTOR_WIDTH, y // st.SECTOR_HEIGHT))
+        
+        
+    def flush(self):
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.buffer.clear()
+            
+            
+    def rotate(self):
+        '''
+        starts a new journal and returns the dirty sectors of the old one
+        '''
+        self.flush()
+        self.file.close()
+        if os.path.isfile(self.rotated_path):
+            # the last rewrite of the world file didn't finish, 
+            # keep the records of both journals
+            with open(self.rotated_path, 'ab') as file:
+                file.write(journal_data(self.path))
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.rotated_path)
+        self.open()
+        dirty = self.dirty
+        self.dirty = set()
+        return dirty
+    
+    
+    def remove_rotated(self):
+        if os.path.isfile(self.rotated_path):
+            os.remove(self.rotated_path)
+            
+            
+    def close(self):
+        self.flush()
+        self.file.close()
+        
+        
+        
+def journal_data(path):
+    '''
+    returns the complete records of a journal file as bytes
+    '''
+    with open(path, 'rb') as file:
+        data = file.read()
+    magic, version = JOURNAL_HEADER.unpack_from(data.ljust(
+            JOURNAL_HEADER.size, b'\0'))
+    if magic != JOURNAL_MAGIC or version != VERSION:
+        return b''
+    data = data[JOURNAL_HEADER.size:]
+    # a record that was cut off by a crash is ignored
+    return data[:len(data) - len(data) % RECORD.size]
+
+
+def read_journal(path):
+    '''
+    returns the (x, y, block ID) records of a journal, oldest first
+    '''
+    if not os.path.isfile(path):
+        return []
+    return list(RECORD.iter_unpack(journal_data(path)))